@@ -0,0 +1,26 @@
+import threading
+
+class Account:
+    """An itslearning login with its own output folder, state folder and access token.
+
+    Several accounts can be synced by one process; the threads of the
+    shared executors are bound to the account of their current task.
+    """
+
+    def __init__(self, name, username, password, instance, page_host, resource_host, output_folder, state_dir, token_cache_path=None):
+        self.name = name
+        self.username = username
+        self.password = password
+        self.instance = instance
+        self.page_host = page_host
+        self.resource_host = resource_host
+        self.output_folder = output_folder
+        self.state_dir = state_dir
+        self.token_cache_path = token_cache_path
+        self.token_cache = None
+        self.token = None  # Token response of the login, with the refresh token
+        self.access_token = None
+        self.token_lock = threading.Lock()
+
+    def __repr__(self):
+        return f"Account({self.name!r}, {self.username!r}, {self.instance!r})"
@@ -0,0 +1,310 @@
+"""Local stand-in for the itslearning endpoints used by itslearning-dl.
+
+Serves the OAuth token, course list, course/folder resources, SSO URL, SSO
+page, iframe pages, filesblock links and DownloadRedirect.ashx with a
+generated course tree. Latency, file sizes, tree shape and error rates are
+configurable, and every request is counted.
+
+Run standalone with: python benchmarks/mock_itslearning.py --port 8080
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+class MockConfig:
+    def __init__(self, courses=3, folders=3, depth=2, files=5, min_size=10_000, max_size=200_000,
+                 multi_file_ratio=0.1, duplicate_ratio=0.0, latency=0.0, error_rate=0.0, token_lifetime=0, max_page_size=0, seed=1):
+        self.courses = courses
+        self.folders = folders
+        self.depth = depth
+        self.files = files
+        self.min_size = min_size
+        self.max_size = max_size
+        self.multi_file_ratio = multi_file_ratio
+        self.duplicate_ratio = duplicate_ratio
+        self.latency = latency
+        self.error_rate = error_rate
+        self.token_lifetime = token_lifetime
+        self.max_page_size = max_page_size
+        self.seed = seed
+
+class MockItslearning:
+    """Generated course tree and request statistics of the mock server."""
+
+    def __init__(self, config):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.courses = []
+        self.listings = {}  # (course_id, folder_id or None) -> resources
+        self.elements = {}  # element_id -> list of (filename, size)
+        self.origins = {}  # element_id -> element_id whose files it publishes again
+        self.next_id = 1000
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.bytes_sent = 0
+        self.first_listing = None
+        self.last_listing = None
+        self.tokens = {}  # access token -> expiry
+        self.refresh_tokens = set()
+        for course_id in range(1, config.courses + 1):
+            title = f"Course {course_id}"
+            self.courses.append({"CourseId": course_id, "Title": title, "LastUpdatedUtc": "2024-01-01T00:00:00Z"})
+            self.build_folder(course_id, None, title, 0)
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def build_folder(self, course_id, folder_id, path, depth):
+        resources = []
+        for _ in range(self.config.files):
+            element_id = self.new_id()
+            if self.config.duplicate_ratio and self.elements and self.random.random() < self.config.duplicate_ratio:
+                # The same file published in another folder or course
+                origin = self.random.choice(sorted(self.elements))
+                self.origins[element_id] = self.origins.get(origin, origin)
+                self.elements[element_id] = self.elements[origin]
+                resources.append({"ElementId": element_id, "Title": f"Element {element_id}", "Path": path,
+                                  "ElementType": "LearningToolElement", "LastUpdatedUtc": "2024-01-01T00:00:00Z"})
+                continue
+            count = self.random.randint(2, 4) if self.random.random() < self.config.multi_file_ratio else 1
+            self.elements[element_id] = [(f"file{element_id}_{index}.bin", self.random.randint(self.config.min_size, self.config.max_size))
+                                         for index in range(count)]
+            resources.append({"ElementId": element_id, "Title": f"Element {element_id}", "Path": path,
+                              "ElementType": "LearningToolElement", "LastUpdatedUtc": "2024-01-01T00:00:00Z"})
+        if depth < self.config.depth:
+            for _ in range(self.config.folders):
+                child_id = self.new_id()
+                title = f"Folder {child_id}"
+                resources.append({"ElementId": child_id, "Title": title, "Path": path,
+                                  "ElementType": "Folder", "LastUpdatedUtc": "2024-01-01T00:00:00Z"})
+                self.build_folder(course_id, child_id, f"{path}/{title}", depth + 1)
+        self.listings[(course_id, folder_id)] = resources
+
+    def total_files(self):
+        return sum(len(files) for files in self.elements.values())
+
+    def total_bytes(self):
+        return sum(size for files in self.elements.values() for _, size in files)
+
+    def count(self, name, sent=0):
+        with self.lock:
+            self.counts[name] += 1
+            self.bytes_sent += sent
+
+    def issue_token(self):
+        with self.lock:
+            number = len(self.tokens) + 1
+            self.tokens[f"access-{number}"] = time.monotonic() + (self.config.token_lifetime or 3600)
+            self.refresh_tokens.add(f"refresh-{number}")
+        return {"access_token": f"access-{number}", "refresh_token": f"refresh-{number}",
+                "expires_in": self.config.token_lifetime or 3600, "token_type": "bearer"}
+
+    def token_valid(self, access_token):
+        # Without a token lifetime every token is accepted
+        if not self.config.token_lifetime:
+            return True
+        with self.lock:
+            return self.tokens.get(access_token, 0) > time.monotonic()
+
+    def mark_listing(self):
+        now = time.monotonic()
+        with self.lock:
+            self.first_listing = self.first_listing or now
+            self.last_listing = now
+
+    def file_bytes(self, element_id, index):
+        # Deterministic content, so repeated and ranged requests match
+        filename, size = self.elements[element_id][index]
+        block = f"{self.origins.get(element_id, element_id)}:{index};".encode()
+        return filename, (block * (size // len(block) + 1))[:size]
+
+def make_handler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send(self, status, body, content_type="application/json", extra_headers=None):
+            if isinstance(body, (dict, list)):
+                body = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (extra_headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+
+        def page(self, entities, query):
+            index = int(query.get("pageIndex", ["0"])[0])
+            size = int(query.get("pageSize", ["9999"])[0])
+            if mock.config.max_page_size:
+                size = min(size, mock.config.max_page_size)
+            return {"EntityArray": entities[index * size:(index + 1) * size], "Total": len(entities),
+                    "CurrentPageIndex": index, "PageSize": size}
+
+        def base_url(self):
+            return f"http://{self.headers['Host']}"
+
+        def do_POST(self):
+            form = parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode())
+            grant_type = form.get("grant_type", ["password"])[0]
+            mock.count(f"token_{grant_type}")
+            if grant_type == "refresh_token" and form.get("refresh_token", [""])[0] not in mock.refresh_tokens:
+                return self.send(400, {"error": "invalid_grant"})
+            self.send(200, mock.issue_token())
+
+        def do_HEAD(self):
+            self.do_GET()
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            parts = url.path.strip("/").split("/")
+            if mock.config.latency:
+                time.sleep(mock.config.latency)
+            if mock.config.error_rate and mock.random.random() < mock.config.error_rate:
+                mock.count("error")
+                return self.send(503, b"busy", "text/plain", {"Retry-After": "0"})
+
+            if url.path.startswith("/restapi/") and not mock.token_valid(query.get("access_token", [""])[0]):
+                mock.count("unauthorized")
+                return self.send(401, {"error": "invalid_token"})
+            if url.path == "/restapi/personal/courses/v2":
+                mock.count("courses")
+                mock.mark_listing()
+                return self.send(200, self.page(mock.courses, query))
+            if url.path.startswith("/restapi/personal/courses/") and url.path.endswith("/resources/v1"):
+                mock.count("resources")
+                mock.mark_listing()
+                course_id = int(parts[3])
+                folder_id = int(parts[5]) if parts[4] == "folders" else None
+                return self.send(200, {"Resources": self.page(mock.listings[(course_id, folder_id)], query)})
+            if url.path == "/restapi/personal/sso/url/v1":
+                mock.count("sso_url")
+                element_id = query["url"][0].split("=")[-1]
+                return self.send(200, {"Url": f"{self.base_url()}/sso?element={element_id}"})
+            if url.path == "/sso":
+                mock.count("sso")
+                element_id = int(query["element"][0])
+                if len(mock.elements[element_id]) > 1:
+                    src = f"{self.base_url()}/filesblock?element={element_id}"
+                else:
+                    src = f"{self.base_url()}/viewer?LearningObjectId={element_id}&LearningObjectInstanceId=1"
+                return self.send(200, f'<html><body><div class="viewer"><iframe src="{src}"></iframe></div></body></html>'.encode(),
+                                 "text/html", {"Set-Cookie": "sso=1; Path=/"})
+            if url.path == "/viewer":
+                mock.count("iframe")
+                return self.send(200, b"<html><body>viewer</body></html>", "text/html")
+            if url.path == "/filesblock":
+                mock.count("iframe")
+                element_id = int(query["element"][0])
+                links = "".join(f'<li class="ilw-filesblock-li"><a href="/File/download?element={element_id}&amp;index={index}">{name}</a></li>'
+                                for index, (name, _) in enumerate(mock.elements[element_id]))
+                return self.send(200, f'<html><body><ul class="ilw-filesblock">{links}</ul></body></html>'.encode(), "text/html")
+            if url.path in ("/Proxy/DownloadRedirect.ashx", "/File/download"):
+                if "sso=1" not in self.headers.get("Cookie", ""):
+                    mock.count("login_page")
+                    return self.send(200, b"<html><body>login</body></html>", "text/html")
+                if url.path == "/File/download":
+                    filename, data = mock.file_bytes(int(query["element"][0]), int(query["index"][0]))
+                else:
+                    filename, data = mock.file_bytes(int(query["LearningObjectId"][0]), 0)
+                return self.send_file(filename, data)
+            mock.count("not_found")
+            self.send(404, {})
+
+        def send_file(self, filename, data):
+            extra = {"Accept-Ranges": "bytes", "ETag": f'"{len(data)}-{filename}"',
+                     "Content-Disposition": f'attachment; filename="{filename}"'}
+            match = self.headers.get("Range", "")
+            if_range = self.headers.get("If-Range")
+            if match.startswith("bytes=") and (if_range is None or if_range == extra["ETag"]):
+                start, _, end = match[6:].partition("-")
+                start = int(start)
+                if start >= len(data):
+                    mock.count("file_unsatisfiable")
+                    return self.send(416, b"", "text/plain", {"Content-Range": f"bytes */{len(data)}"})
+                end = int(end) if end else len(data) - 1
+                extra["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+                mock.count("file_range", end + 1 - start)
+                return self.send(206, data[start:end + 1], "application/octet-stream", extra)
+            mock.count("file", len(data))
+            self.send(200, data, "application/octet-stream", extra)
+
+    return Handler
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops connections under concurrent load
+    request_queue_size = 256
+
+    def handle_error(self, request, client_address):
+        # Clients close streamed downloads early, e.g. when a file is unchanged
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+class MockServer:
+    """Run the mock in a background thread."""
+
+    def __init__(self, config, host="127.0.0.1", port=0):
+        self.mock = MockItslearning(config)
+        self.server = MockHTTPServer((host, port), make_handler(self.mock))
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+def add_config_arguments(parser):
+    parser.add_argument("--courses", type=int, default=3)
+    parser.add_argument("--folders", type=int, default=3, help="Sub folders per folder")
+    parser.add_argument("--depth", type=int, default=2, help="Folder depth below the course root")
+    parser.add_argument("--files", type=int, default=5, help="Elements per folder")
+    parser.add_argument("--min-size", type=int, default=10_000, help="Minimum file size in bytes")
+    parser.add_argument("--max-size", type=int, default=200_000, help="Maximum file size in bytes")
+    parser.add_argument("--multi-file-ratio", type=float, default=0.1, help="Share of elements with several files")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.0, help="Share of elements that publish the files of another element again")
+    parser.add_argument("--latency", type=float, default=0.0, help="Added latency per request in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 503")
+    parser.add_argument("--token-lifetime", type=float, default=0, help="Seconds until an access token expires, 0 to accept any token")
+    parser.add_argument("--max-page-size", type=int, default=0, help="Largest page size the server sends, 0 for no limit")
+    parser.add_argument("--seed", type=int, default=1)
+
+def config_from_args(args):
+    return MockConfig(courses=args.courses, folders=args.folders, depth=args.depth, files=args.files,
+                      min_size=args.min_size, max_size=args.max_size, multi_file_ratio=args.multi_file_ratio,
+                      duplicate_ratio=args.duplicate_ratio,
+                      latency=args.latency, error_rate=args.error_rate,
+                      token_lifetime=args.token_lifetime, max_page_size=args.max_page_size, seed=args.seed)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock itslearning server")
+    parser.add_argument("--port", type=int, default=8080)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    with MockServer(config_from_args(args), port=args.port) as server:
+        print(f"Serving {server.mock.total_files()} files ({server.mock.total_bytes()} bytes) on {server.url}")
+        print(f"Config: ITSLEARNING_INSTANCE, ITSLEARNING_PAGE_HOST and ITSLEARNING_RESOURCE_HOST: '{server.url}'")
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            pass
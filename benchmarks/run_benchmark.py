@@ -0,0 +1,153 @@
+"""End-to-end benchmark of itslearning-dl against the local mock server.
+
+Every run starts itslearning_dl.py in a fresh temporary home folder (so the
+state is empty) and reports crawl time, download throughput, peak RSS and
+the request counts seen by the server for each engine and worker count.
+The peak RSS is the sum over the tool and its worker processes, sampled
+from /proc; the largest single process is reported as well.
+
+Example:
+    python benchmarks/run_benchmark.py --engines async pool --workers 5 20 --latency 0.02
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from mock_itslearning import MockServer, add_config_arguments, config_from_args
+
+REPO = Path(__file__).resolve().parent.parent
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+RSS_INTERVAL = 0.05  # Seconds between two samples of the process tree
+
+def process_tree(pid):
+    """Get the PID of a process and of all its descendants from /proc."""
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name in parentheses may contain spaces
+                parents.setdefault(int(f.read().rpartition(")")[2].split()[1]), []).append(int(entry))
+        except (OSError, IndexError, ValueError):
+            pass
+    pids = [pid]
+    for current in pids:
+        pids.extend(parents.get(current, ()))
+    return pids
+
+def tree_rss(pid):
+    """Get the summed RSS of a process tree in bytes."""
+    total = 0
+    for current in process_tree(pid):
+        try:
+            with open(f"/proc/{current}/statm") as f:
+                total += int(f.read().split()[1]) * PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+def sample_tree_rss(pid, stop, peak):
+    """Record the largest summed RSS of the process tree in peak[0] until stop is set."""
+    while not stop.is_set():
+        peak[0] = max(peak[0], tree_rss(pid))
+        stop.wait(RSS_INTERVAL)
+
+def write_conf(home, url):
+    sys_path = Path(home) / "Documents" / "itslearning-dl"
+    sys_path.mkdir(parents=True)
+    with open(sys_path / "itslearning-dl.conf", "w") as f:
+        f.write("ITSLEARNING_USERNAME: 'benchmark'\n")
+        f.write("ITSLEARNING_PASSWORD: 'benchmark'\n")
+        f.write(f"ITSLEARNING_INSTANCE: '{url}'\n")
+        f.write(f"ITSLEARNING_PAGE_HOST: '{url}'\n")
+        f.write(f"ITSLEARNING_RESOURCE_HOST: '{url}'\n")
+        f.write("ITSLEARNINGDL_LOGFILE: false\n")
+    return sys_path
+
+def run_once(config, engine, workers, extra_args):
+    """Run the tool once against a new mock server and collect the measurements."""
+    with MockServer(config) as server, tempfile.TemporaryDirectory() as home:
+        write_conf(home, server.url)
+        out = Path(home) / "out"
+        env = dict(os.environ, HOME=home, USERPROFILE=home)
+        command = [sys.executable, str(REPO / "itslearning_dl.py"), "--engine", engine, "--worker", str(workers),
+                   "--path", str(out), "--loglvl", "warning", *extra_args]
+        # Progress bars go to stderr, a file can't fill up like a pipe
+        with tempfile.TemporaryFile() as stderr_file:
+            start = time.monotonic()
+            process = subprocess.Popen(command, env=env, cwd=home, stdout=subprocess.DEVNULL, stderr=stderr_file)
+            stop, peak = threading.Event(), [0]
+            sampler = None
+            if os.path.isdir("/proc"):
+                sampler = threading.Thread(target=sample_tree_rss, args=(process.pid, stop, peak), daemon=True)
+                sampler.start()
+            _, status, usage = os.wait4(process.pid, 0)
+            wall = time.monotonic() - start
+            stop.set()
+            if sampler is not None:
+                sampler.join()
+            stderr_file.seek(0)
+            stderr = stderr_file.read().decode(errors="replace")
+        mock = server.mock
+        files = sum(1 for path in out.rglob("*") if path.is_file() and not path.name.endswith(".part")) if out.exists() else 0
+        crawl = (mock.last_listing - mock.first_listing) if mock.first_listing else 0
+        return {
+            "engine": engine,
+            "workers": workers,
+            "exit_code": os.waitstatus_to_exitcode(status),
+            "wall_s": round(wall, 3),
+            "crawl_s": round(crawl, 3),
+            "files": files,
+            "expected_files": mock.total_files(),
+            "files_per_s": round(files / wall, 2),
+            "mb_per_s": round(mock.bytes_sent / wall / 1e6, 2),
+            # Summed over the process tree; shared pages of forked workers count once per process.
+            # Without /proc only the largest single process is known.
+            "peak_rss_mb": round(peak[0] / 1e6 if peak[0] else usage.ru_maxrss / 1024, 1),
+            # ru_maxrss is KiB on Linux, the largest of the tool and its waited-for workers
+            "max_process_rss_mb": round(usage.ru_maxrss / 1024, 1),
+            "requests": dict(mock.counts),
+            "stderr": stderr[-2000:] if os.waitstatus_to_exitcode(status) else "",
+        }
+
+def print_table(results):
+    columns = ["engine", "workers", "wall_s", "crawl_s", "files", "files_per_s", "mb_per_s", "peak_rss_mb", "max_process_rss_mb"]
+    print(" | ".join(f"{column:>11}" for column in columns + ["requests"]))
+    for result in results:
+        requests = sum(result["requests"].values())
+        print(" | ".join(f"{result[column]!s:>11}" for column in columns) + f" | {requests:>11}")
+        if result["files"] != result["expected_files"]:
+            print(f"    warning: {result['files']} of {result['expected_files']} files downloaded (exit code {result['exit_code']})")
+        if result["stderr"]:
+            print("    " + result["stderr"].strip().replace("\n", "\n    "))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark itslearning-dl against a local mock server.")
+    parser.add_argument("--engines", nargs="+", default=["async", "pool"])
+    parser.add_argument("--workers", nargs="+", type=int, default=[5, 20])
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--json", help="Write the results to this JSON file")
+    parser.add_argument("tool_args", nargs="*", help="Extra arguments for itslearning_dl.py (after --)")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    config = config_from_args(args)
+
+    results = []
+    for engine in args.engines:
+        for workers in args.workers:
+            for _ in range(args.repeat):
+                results.append(run_once(config, engine, workers, args.tool_args))
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
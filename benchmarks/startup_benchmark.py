@@ -0,0 +1,82 @@
+"""Startup time of itslearning-dl.
+
+Measures the time to import the module (what every spawned pool worker pays)
+and to run '--help' (argument parsing with the config loaded), against a
+bare interpreter start as the baseline. With --importtime the slowest
+imports of the module are listed.
+
+Example:
+    python benchmarks/startup_benchmark.py --repeat 20 --importtime
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+
+COMMANDS = {
+    "python": [sys.executable, "-c", "pass"],
+    "import": [sys.executable, "-c", "import itslearning_dl"],
+    "help": [sys.executable, str(REPO / "itslearning_dl.py"), "--help"],
+}
+
+def write_conf(home):
+    sys_path = Path(home) / "Documents" / "itslearning-dl"
+    sys_path.mkdir(parents=True)
+    with open(sys_path / "itslearning-dl.conf", "w") as f:
+        f.write("ITSLEARNING_USERNAME: 'benchmark'\n")
+        f.write("ITSLEARNING_PASSWORD: 'benchmark'\n")
+        f.write("ITSLEARNING_INSTANCE: 'https://example.itslearning.com'\n")
+
+def time_command(command, env, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, cwd=REPO, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+def slowest_imports(env, count):
+    """Parse 'python -X importtime' and return the direct imports of the module by cumulative time."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import itslearning_dl"],
+                            env=env, cwd=REPO, capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are listed before their parent, indented by two spaces per level
+        indent = len(name) - len(name.lstrip())
+        if indent == 1:
+            if name.strip() == "itslearning_dl":
+                break
+            imports = []
+        elif indent == 3:
+            imports.append((int(cumulative) / 1000, name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the startup time of itslearning-dl.")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--importtime", action="store_true", help="List the slowest imports of the module")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        write_conf(home)
+        env = dict(os.environ, HOME=home, USERPROFILE=home)
+        print(f"{'command':>8} | {'min ms':>8} | {'median ms':>9}")
+        for name, command in COMMANDS.items():
+            times = time_command(command, env, args.repeat)
+            print(f"{name:>8} | {min(times):>8.1f} | {statistics.median(times):>9.1f}")
+        if args.importtime:
+            print()
+            for cumulative, name in slowest_imports(env, 10):
+                print(f"{cumulative:>8.1f} ms  {name}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import json
+import os
+import shutil
+import sys
+import threading
+import logging
+from urllib.parse import urlparse
+
+# ioctl of Linux to share the extents of a file (btrfs, xfs, ...), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+def reflink(src, dst):
+    """Copy-on-write clone of a file; raises OSError where unsupported."""
+    if not sys.platform.startswith("linux"):
+        raise OSError("reflinks are only supported on Linux")
+    import fcntl
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            os.remove(dst)
+            raise
+
+class BlobStore:
+    """Content-addressed store of downloaded files.
+
+    Every file is kept once as blobs/<sha256[:2]>/<sha256>; the course folders
+    get hardlinks (or reflinks, or copies if neither works) to the blobs. An
+    index maps the validators of a file response (host, ETag and size) to the
+    hash of its content, so a file published in several courses is only
+    transferred once. The index is append-only, so processes of the pool
+    engine can share it.
+    """
+
+    def __init__(self, root):
+        self.root = str(root)
+        self.index_path = os.path.join(self.root, "index.jsonl")
+        self.lock = threading.Lock()
+        self.index = {}
+        os.makedirs(os.path.join(self.root, "blobs"), exist_ok=True)
+        self.load_index()
+
+    def load_index(self):
+        try:
+            with open(self.index_path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut off by an interrupted run
+                        continue
+                    self.index[entry["key"]] = entry["sha256"]
+        except FileNotFoundError:
+            pass
+
+    def blob_path(self, sha256):
+        return os.path.join(self.root, "blobs", sha256[:2], sha256)
+
+    def lookup(self, key):
+        """Get the hash of the stored content of a validator key, None if it is not stored."""
+        with self.lock:
+            sha256 = self.index.get(key)
+        if sha256 is None or not os.path.exists(self.blob_path(sha256)):
+            return None
+        return sha256
+
+    def remember(self, key, sha256):
+        with self.lock:
+            if self.index.get(key) == sha256:
+                return
+            self.index[key] = sha256
+            # One short line per write, appends of other processes don't interleave with it
+            with open(self.index_path, "a") as f:
+                f.write(json.dumps({"key": key, "sha256": sha256}) + "\n")
+
+    def add(self, path, sha256, key=None):
+        """Move a downloaded file into the store; returns False if the content was already stored."""
+        blob_path = self.blob_path(sha256)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        stored = not os.path.exists(blob_path)
+        if stored:
+            os.replace(path, blob_path)
+        else:
+            os.remove(path)
+        if key is not None:
+            self.remember(key, sha256)
+        return stored
+
+    def place(self, sha256, dest_path):
+        """Put the content of a blob at dest_path; returns 'hardlink', 'reflink' or 'copy'."""
+        blob_path = self.blob_path(sha256)
+        if os.path.exists(dest_path) and os.path.samefile(blob_path, dest_path):
+            # Linked already; renaming a link over the same file would leave the temporary link behind
+            return "hardlink"
+        tmp_path = f"{dest_path}.link"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(blob_path, tmp_path)
+            method = "hardlink"
+        except OSError:
+            try:
+                reflink(blob_path, tmp_path)
+                method = "reflink"
+            except OSError:
+                shutil.copyfile(blob_path, tmp_path)
+                method = "copy"
+        os.replace(tmp_path, dest_path)
+        logging.debug(f" > {method} from blob {sha256}")
+        return method
+
+def blob_key(response):
+    """Validator key of a file response, None if the server gives no stable identifier."""
+    etag = response.headers.get("ETag")
+    length = response.headers.get("Content-Length")
+    if not etag or etag.startswith("W/") or response.headers.get("Content-Encoding", "identity") != "identity":
+        return None
+    if response.status_code == 206:
+        # The full size of a resumed transfer
+        length = response.headers.get("Content-Range", "").rpartition("/")[2]
+    if not length or not length.isdigit():
+        return None
+    return f"{urlparse(response.url).netloc}|{etag}|{length}"
@@ -62,12 +62,84 @@ class ConfManager:
             f.write("#ITSLEARNINGDL_OUT: ''\n\n")
             f.write("# Enable or disable log file (default: true)\n")
             f.write("#ITSLEARNINGDL_LOGFILE: true\n\n")
-            f.write("# Set number of worker processes to use for downloading (default: 20)\n")
+            f.write("# Set number of concurrent downloads (default: 20)\n")
             f.write("#WORKER_COUNT: 20\n\n")
+            f.write("# Set number of concurrent folder requests while crawling (default: 8)\n")
+            f.write("#CRAWL_WORKER_COUNT: 8\n\n")
+            f.write("# Set the entries per page of the course and folder listings and how many of the\n")
+            f.write("# following pages are requested ahead while one is handled (default: 100, 1)\n")
+            f.write("#PAGE_SIZE: 100\n")
+            f.write("#PAGE_PREFETCH: 1\n\n")
+            f.write("# Set the chunk size in bytes for writing downloads (default: 1048576)\n")
+            f.write("#CHUNK_SIZE: 1048576\n\n")
+            f.write("# Download files larger than SEGMENT_SIZE bytes in up to SEGMENTS parallel ranged requests\n")
+            f.write("# if the host supports it; 0 disables it (default: 33554432, 4)\n")
+            f.write("#SEGMENT_SIZE: 33554432\n")
+            f.write("#SEGMENTS: 4\n\n")
+            f.write("# Set how many seconds the resolved download location of an element is reused,\n")
+            f.write("# which skips the SSO and iframe requests; 0 disables the cache (default: 604800)\n")
+            f.write("#RESOLUTION_TTL: 604800\n\n")
+            f.write("# Set the HTML extractor for the SSO and iframe pages: 'auto', 'stream', 'bs4' or 'selectolax'\n")
+            f.write("# 'auto' uses the stdlib parser; selectolax is faster but handles malformed pages differently (default: auto)\n")
+            f.write("#HTML_EXTRACTOR: auto\n\n")
+            f.write("# Set the number of retries of a failed or throttled (429/503) request (default: 4)\n")
+            f.write("# Concurrency per host adapts automatically up to WORKER_COUNT.\n")
+            f.write("#MAX_RETRIES: 4\n\n")
+            f.write("# Set the read timeout of a request in seconds (default: 30)\n")
+            f.write("#REQUEST_TIMEOUT: 30\n\n")
+            f.write("# Keep every file once in this folder and hardlink (or reflink/copy) it into the course folders (default: off)\n")
+            f.write("# Hardlinks need the same file system as the output folder, e.g. a folder inside it.\n")
+            f.write("#DEDUP_STORE: ''\n\n")
+            f.write("# Cache the access token in token.json (user-readable only) and refresh it instead of logging in every run (default: true)\n")
+            f.write("#TOKEN_CACHE: true\n\n")
+            f.write("# Write metrics of every run to this file, Prometheus format for '.prom', otherwise JSON (default: off)\n")
+            f.write("#METRICS_FILE: /var/lib/node_exporter/textfile/itslearning_dl.prom\n\n")
+            f.write("# Set the seconds between the polls of the watch mode (--watch) and the random share they vary by (default: 900, 0.1)\n")
+            f.write("#WATCH_INTERVAL: 900\n")
+            f.write("#WATCH_JITTER: 0.1\n\n")
+            f.write("# Set the download engine: 'async' (shared connection pool) or 'pool' (worker processes) (default: async)\n")
+            f.write("#DOWNLOAD_ENGINE: async\n\n")
+            f.write("# Failed downloads are retried on the next runs until this many attempts failed (default: 5)\n")
+            f.write("# Use --retry-failed to retry all of them without crawling.\n")
+            f.write("#FAILURE_RETRY_LIMIT: 5\n\n")
+            f.write("# Sync several accounts (and instances) in one run instead of the single account above;\n")
+            f.write("# each gets its own state and token in accounts/<NAME> and its own output folder\n")
+            f.write("# (default: <output folder>/<NAME>). ITSLEARNING_PAGE_HOST and ITSLEARNING_RESOURCE_HOST\n")
+            f.write("# can be set per account as well. Select some of them with --account NAME.\n")
+            f.write("#ACCOUNTS:\n")
+            f.write("#  - NAME: alice\n")
+            f.write("#    ITSLEARNING_USERNAME: alice\n")
+            f.write("#    ITSLEARNING_PASSWORD: secret\n")
+            f.write("#    ITSLEARNING_INSTANCE: https://school.itslearning.com\n")
+            f.write("#  - NAME: bob\n")
+            f.write("#    ITSLEARNING_USERNAME: bob\n")
+            f.write("#    ITSLEARNING_PASSWORD: secret\n")
+            f.write("#    ITSLEARNING_INSTANCE: https://other.itslearning.com\n")
+            f.write("#    ITSLEARNINGDL_OUT: /data/bob\n\n")
+            f.write("# Only crawl some courses, by ID or title glob, and skip others (default: all courses)\n")
+            f.write("#INCLUDE_COURSES: [12345, 'Math*']\n")
+            f.write("#EXCLUDE_COURSES: ['*2019*']\n\n")
+            f.write("# Only crawl the folders and elements matching a path glob like 'Course/Folder/Element',\n")
+            f.write("# and skip others; a rule on a folder applies to everything in it. '*' matches within\n")
+            f.write("# a folder name, '**' across folders. Excluded folders are not requested at all.\n")
+            f.write("#INCLUDE_PATHS: ['Math 101/Lectures', '**/*.pdf']\n")
+            f.write("#EXCLUDE_PATHS: ['*/Archive']\n\n")
+            f.write("# Only crawl resources of these ElementTypes, e.g. without Folder only the course roots (default: all)\n")
+            f.write("#ELEMENT_TYPES: [Folder, LearningToolElement]\n\n")
+            f.write("# Skip files larger than this many bytes, 0 for no limit (default: 0)\n")
+            f.write("#MAX_FILE_SIZE: 0\n\n")
+            f.write("# Take the content of folders with an unchanged LastUpdatedUtc from the snapshot of the last\n")
+            f.write("# crawl instead of requesting them (or use --prune-folders). Only correct if itslearning updates the\n")
+            f.write("# LastUpdatedUtc of every parent folder when something inside changes, otherwise changes in\n")
+            f.write("# subfolders are missed (default: false)\n")
+            f.write("#FOLDER_PRUNING: false\n\n")
             f.write("# Set true to refetch all elements every time and ignore the previous state (default: false)\n")
             f.write("# Note: This is not recommended as it will cause all data to be re-downloaded every time,\n")
             f.write("# which can be slow and inefficient. Please use this setting judiciously.\n")
             f.write("#IGNORE_STATE: true\n\n")
+            f.write("# Set the state backend: 'sqlite' (state.db) or 'json' (state.json) (default: sqlite)\n")
+            f.write("# An existing state.json is migrated to state.db on the first run.\n")
+            f.write("#STATE_BACKEND: sqlite\n\n")
             f.write("# Set the log level for the log file and console out (default: info)\n")
             f.write("# Note: Setting the log level higher than 'info', such as 'debug', and enabling the log file\n")
             f.write("# could potentially save sensitive information like credentials or session details in the log file.\n")
@@ -0,0 +1,94 @@
+import re
+
+def glob_regex(pattern):
+    """Compile a path glob: '*' and '?' stay within a path segment, '**' spans segments."""
+    parts = []
+    for token in re.split(r"(\*\*|\*|\?)", pattern):
+        if token == "**":
+            parts.append(".*")
+        elif token == "*":
+            parts.append("[^/]*")
+        elif token == "?":
+            parts.append("[^/]")
+        else:
+            parts.append(re.escape(token))
+    return re.compile("".join(parts), re.IGNORECASE)
+
+class PathGlob:
+    """A glob on paths like 'Course/Folder/Element', applying to the subtree of a matching folder."""
+
+    def __init__(self, pattern):
+        self.pattern = pattern.strip("/")
+        self.regex = glob_regex(self.pattern)
+        self.segments = [None if "**" in segment else glob_regex(segment) for segment in self.pattern.split("/")]
+
+    def matches(self, segments):
+        """Check whether the path or one of its folders matches."""
+        return any(self.regex.fullmatch("/".join(segments[:end])) for end in range(1, len(segments) + 1))
+
+    def may_contain(self, segments):
+        """Check whether a folder can contain a path that matches."""
+        for index, segment in enumerate(segments):
+            if index >= len(self.segments):
+                return False
+            if self.segments[index] is None:
+                return True
+            if not self.segments[index].fullmatch(segment):
+                return False
+        return True
+
+class CrawlFilter:
+    """Include and exclude rules of the crawl, compiled once.
+
+    Courses are selected by ID or title glob and checked before their folder
+    tree is queried; folders are checked before they are queried, so an
+    excluded subtree costs no requests. Empty include rules include all.
+    """
+
+    def __init__(self, include_courses=(), exclude_courses=(), include_paths=(), exclude_paths=(), element_types=()):
+        self.include_courses = [self.course_rule(rule) for rule in include_courses]
+        self.exclude_courses = [self.course_rule(rule) for rule in exclude_courses]
+        self.include_paths = [PathGlob(pattern) for pattern in include_paths]
+        self.exclude_paths = [PathGlob(pattern) for pattern in exclude_paths]
+        self.element_types = {element_type.lower() for element_type in element_types}
+
+    @staticmethod
+    def course_rule(rule):
+        rule = str(rule).strip()
+        return rule if rule.isdigit() else glob_regex(rule)
+
+    @staticmethod
+    def course_matches(rules, course):
+        for rule in rules:
+            if isinstance(rule, str):
+                if rule == str(course["CourseId"]):
+                    return True
+            elif rule.fullmatch(course.get("Title") or ""):
+                return True
+        return False
+
+    def course(self, course):
+        """Check whether a course of the course list is crawled."""
+        if self.include_courses and not self.course_matches(self.include_courses, course):
+            return False
+        if self.exclude_courses and self.course_matches(self.exclude_courses, course):
+            return False
+        # The paths of the resources start with the course title
+        return self.path(course.get("Title") or "", True)
+
+    def resource(self, resource, path):
+        """Check whether a folder is queried or an element downloaded; path is its sanitized folder path."""
+        if self.element_types and resource["ElementType"].lower() not in self.element_types:
+            return False
+        return self.path(f"{path}/{resource['Title']}", resource["ElementType"] == "Folder")
+
+    def path(self, path, folder):
+        """Check the path rules; a folder passes if it can contain an included path."""
+        segments = [segment for segment in path.split("/") if segment]
+        if any(glob.matches(segments) for glob in self.exclude_paths):
+            return False
+        if not self.include_paths:
+            return True
+        if folder:
+            return any(glob.matches(segments) or glob.may_contain(segments) for glob in self.include_paths)
+        return any(glob.matches(segments) for glob in self.include_paths)
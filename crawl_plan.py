@@ -0,0 +1,60 @@
+import json
+import os
+import zlib
+
+# Keys of a resource in a plan
+PLAN_KEYS = ("ElementId", "Title", "Path", "CourseId", "LastUpdatedUtc")
+
+def parse_shard(text):
+    """Parse a shard 'i/n' into (i, n), the i-th of n shards counted from 0."""
+    index, separator, count = text.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise ValueError(f"Invalid shard '{text}', expected 'i/n'")
+    if not separator or count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard '{text}', expected 0 <= i < n")
+    return index, count
+
+def in_shard(element_id, shard):
+    """Check whether an element belongs to a shard.
+
+    crc32 of the element ID is stable across processes and machines (unlike
+    hash()), so every host gets the same disjoint subset of a plan.
+    """
+    index, count = shard
+    return zlib.crc32(str(element_id).encode()) % count == index
+
+class PlanWriter:
+    """Write resources as JSON lines; the plan file only appears once it is complete."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.tmp_path = f"{self.path}.tmp"
+        self.count = 0
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.tmp_path, "w", encoding="utf-8")
+        return self
+
+    def write(self, resource):
+        self.file.write(json.dumps({key: resource.get(key) for key in PLAN_KEYS}, ensure_ascii=False) + "\n")
+        self.count += 1
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.file.close()
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.remove(self.tmp_path)
+
+def read_plan(path, shard=(0, 1)):
+    """Yield the resources of a plan that belong to the shard."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            resource = json.loads(line)
+            if in_shard(resource["ElementId"], shard):
+                yield resource
@@ -0,0 +1,98 @@
+# Resource types kept in a snapshot, the others are not crawled
+SNAPSHOT_TYPES = ("Folder", "LearningToolElement")
+
+# The course root in place of a folder ID
+ROOT = ""
+
+class CourseSnapshot:
+    """The crawled tree of a course: its folders and elements with their titles and paths.
+
+    Every entry is a compact list [ElementId, parent folder ID, ElementType,
+    Title, Path, LastUpdatedUtc]. listed holds the folders (and ROOT) whose
+    listing was complete, so the listing of a folder that didn't change can be
+    replayed instead of requested again.
+    """
+
+    def __init__(self, entries=(), listed=()):
+        self.entries = {}
+        self.children = {}
+        self.listed = set(listed)
+        for entry in entries:
+            self.add_entry(entry)
+
+    def add_entry(self, entry):
+        self.entries[str(entry[0])] = entry
+        self.children.setdefault(entry[1], []).append(entry)
+
+    def add_listing(self, folder_id, resources):
+        """Record the complete listing of a folder, ROOT for the course root."""
+        for resource in resources:
+            if resource["ElementType"] in SNAPSHOT_TYPES:
+                self.add_entry([resource["ElementId"], folder_id, resource["ElementType"], resource["Title"],
+                                resource["Path"], resource.get("LastUpdatedUtc")])
+        self.listed.add(folder_id)
+
+    def listing(self, folder_id):
+        """Get the resources of a listed folder, None if its listing is unknown."""
+        if folder_id not in self.listed:
+            return None
+        return [{"ElementId": element_id, "ElementType": element_type, "Title": title, "Path": path, "LastUpdatedUtc": updated}
+                for element_id, _, element_type, title, path, updated in self.children.get(folder_id, [])]
+
+    def unchanged_listing(self, folder):
+        """Get the listing of a folder whose LastUpdatedUtc is the same as in the snapshot, None if it must be requested.
+
+        If the folder or one above it was renamed or moved since, the paths
+        of the listing are rebased onto its current path.
+        """
+        entry = self.entries.get(str(folder["ElementId"]))
+        if entry is None or not folder.get("LastUpdatedUtc") or entry[5] != folder["LastUpdatedUtc"]:
+            return None
+        listing = self.listing(str(folder["ElementId"]))
+        old_base = f"{entry[4]}/{entry[3]}"
+        new_base = f"{folder['Path']}/{folder['Title']}"
+        if listing is None or old_base == new_base:
+            return listing
+        for resource in listing:
+            if resource["Path"] != old_base and not resource["Path"].startswith(old_base + "/"):
+                # Paths that don't follow the folder, request it instead
+                return None
+            resource["Path"] = new_base + resource["Path"][len(old_base):]
+        return listing
+
+    def to_json(self):
+        return {"entries": list(self.entries.values()), "listed": sorted(self.listed)}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["entries"], data["listed"]) if data else None
+
+def diff_snapshots(old, new):
+    """Compare the elements of two snapshots of a course.
+
+    Returns the IDs of the elements that were added, removed, renamed (a new
+    title in the same folder) or moved (to another folder or path, e.g. by
+    renaming a folder above). Elements in folders that one of the snapshots
+    didn't list (e.g. excluded by a filter) are not reported as removed.
+    """
+    diff = {"added": [], "removed": [], "renamed": [], "moved": []}
+    for element_id, entry in new.entries.items():
+        if entry[2] != "LearningToolElement":
+            continue
+        previous = old.entries.get(element_id)
+        if previous is None:
+            diff["added"].append(element_id)
+        elif previous[1] != entry[1] or previous[4] != entry[4]:
+            diff["moved"].append(element_id)
+        elif previous[3] != entry[3]:
+            diff["renamed"].append(element_id)
+    for element_id, entry in old.entries.items():
+        if entry[2] != "LearningToolElement" or element_id in new.entries:
+            continue
+        # The closest folder above it that still exists must have been listed, otherwise it may just not have been crawled
+        parent = entry[1]
+        while parent != ROOT and parent not in new.entries and parent in old.entries:
+            parent = old.entries[parent][1]
+        if parent in new.listed:
+            diff["removed"].append(element_id)
+    return diff
@@ -0,0 +1,129 @@
+from abc import ABC, abstractmethod
+from html.parser import HTMLParser
+
+FILESBLOCK_CLASS = "ilw-filesblock-li"
+
+# Elements without an end tag, they never enclose other elements
+VOID_ELEMENTS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"}
+
+class HtmlExtractor(ABC):
+    """Extract the iframe and file links of the SSO and iframe pages."""
+    name = None
+
+    @abstractmethod
+    def iframe_src(self, html):
+        """Get the src of the first <iframe>, None if there is no iframe."""
+
+    @abstractmethod
+    def file_links(self, html):
+        """Get the hrefs of all links in '.ilw-filesblock-li' elements."""
+
+class BeautifulSoupExtractor(HtmlExtractor):
+    """Reference implementation with a complete BeautifulSoup tree."""
+    name = "bs4"
+
+    def iframe_src(self, html):
+        from bs4 import BeautifulSoup
+        iframe = BeautifulSoup(html, "html.parser").find("iframe")
+        return iframe.get("src") if iframe else None
+
+    def file_links(self, html):
+        from bs4 import BeautifulSoup
+        links = BeautifulSoup(html, "html.parser").select(f".{FILESBLOCK_CLASS} a")
+        return [link.get("href") for link in links if link.get("href") is not None]
+
+class StopParsing(Exception):
+    pass
+
+class IframeParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.found = False
+        self.src = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "iframe":
+            self.found = True
+            self.src = dict(attrs).get("src")
+            raise StopParsing()
+
+class FileLinkParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.stack = []
+        self.filesblock_depth = 0
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "a" and self.filesblock_depth and attrs.get("href") is not None:
+            self.links.append(attrs["href"])
+        if tag in VOID_ELEMENTS:
+            return
+        is_filesblock = FILESBLOCK_CLASS in (attrs.get("class") or "").split()
+        self.stack.append((tag, is_filesblock))
+        self.filesblock_depth += is_filesblock
+
+    def handle_startendtag(self, tag, attrs):
+        # A self-closing tag never encloses anything
+        attrs = dict(attrs)
+        if tag == "a" and self.filesblock_depth and attrs.get("href") is not None:
+            self.links.append(attrs["href"])
+
+    def handle_endtag(self, tag):
+        # Close the element and every unclosed element inside it
+        if not any(open_tag == tag for open_tag, _ in self.stack):
+            return
+        while self.stack:
+            open_tag, is_filesblock = self.stack.pop()
+            self.filesblock_depth -= is_filesblock
+            if open_tag == tag:
+                break
+
+class StreamingExtractor(HtmlExtractor):
+    """Stdlib HTMLParser without a tree; stops at the first iframe."""
+    name = "stream"
+
+    def iframe_src(self, html):
+        parser = IframeParser()
+        try:
+            parser.feed(html)
+            parser.close()
+        except StopParsing:
+            pass
+        return parser.src if parser.found else None
+
+    def file_links(self, html):
+        parser = FileLinkParser()
+        parser.feed(html)
+        parser.close()
+        return parser.links
+
+class SelectolaxExtractor(HtmlExtractor):
+    """Fast C parser of the optional selectolax package.
+
+    It recovers from malformed markup like a browser, not like html.parser:
+    e.g. an unclosed link is repeated into the following list items, so its
+    href is found twice (see tests/pages/malformed_filesblock.html).
+    """
+    name = "selectolax"
+
+    def __init__(self):
+        from selectolax.lexbor import LexborHTMLParser
+        self.parser = LexborHTMLParser
+
+    def iframe_src(self, html):
+        iframe = self.parser(html).css_first("iframe")
+        return iframe.attributes.get("src") if iframe is not None else None
+
+    def file_links(self, html):
+        links = self.parser(html).css(f".{FILESBLOCK_CLASS} a")
+        return [link.attributes["href"] for link in links if link.attributes.get("href") is not None]
+
+EXTRACTORS = {extractor.name: extractor for extractor in (BeautifulSoupExtractor, StreamingExtractor, SelectolaxExtractor)}
+
+def get_extractor(name="auto"):
+    """Create an extractor; 'auto' is the stdlib parser, which matches BeautifulSoup on the pages in tests/pages."""
+    if name == "auto":
+        return StreamingExtractor()
+    return EXTRACTORS[name]()
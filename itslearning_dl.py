@@ -1,57 +1,46 @@
-import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urlparse, parse_qs, unquote, quote_plus, quote
+from urllib.parse import urlparse, parse_qs, unquote, quote_plus
 import re
 from pathlib import Path
-import traceback
 import os
 import signal
 import sys
+import hashlib
 import json
 import datetime
 import time
 import logging
 import argparse
-from tqdm import tqdm
-from tqdm.contrib.logging import logging_redirect_tqdm
-from multiprocessing import Pool, Queue
-import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from functools import partial
+import threading
+import random
 from conf_manager import ConfManager
+from html_extract import EXTRACTORS, get_extractor
+from metrics import metrics
+from token_cache import TokenCache, is_token_valid
+from blob_store import BlobStore, blob_key
+from crawl_plan import PLAN_KEYS, PlanWriter, parse_shard, read_plan
+from size_queue import SizeQueue, remembered_size
+from crawl_filter import CrawlFilter
+from crawl_snapshot import ROOT, CourseSnapshot, diff_snapshots
+from account import Account
+
+# requests, tqdm, multiprocessing, asyncio and the state store are imported where
+# they are used, so --config, --state and the pool workers start quickly
 
 # Define paths
 sys_path = Path.home() / "Documents" / "itslearning-dl"
 state_path = sys_path / 'state.json'
 conf_path = sys_path / 'itslearning-dl.conf'
-output_folder = Path(ConfManager(conf_path).get_param("ITSLEARNINGDL_OUT") or sys_path / 'out')
 logging_path = sys_path / 'log'
 
-# Define parser
-parser = argparse.ArgumentParser(description="ItsLearning-DL TOOL.")
-conf = ConfManager(conf_path)
-
-# Define arguments
-parser.add_argument('-u', '--username', type=str, default=conf.get_param("ITSLEARNING_USERNAME"), help='Set your Itslearning username (default: Config > ITSLEARNING_USERNAME)')
-parser.add_argument('-p', '--password', type=str, default=conf.get_param("ITSLEARNING_PASSWORD"), help='Set your Itslearning password (default: Config > ITSLEARNING_PASSWORD)')
-parser.add_argument('-o', '--path', type=str, default=output_folder, help=f'Set the output folder for downloaded resources (default: Config > ITSLEARNINGDL_OUT): {output_folder})')
-default_ignore_state = conf.get_param("IGNORE_STATE") or False
-parser.add_argument('-a', '--ignorestate', default=default_ignore_state, const=True, action='store_const', help='Force refetch of all elements (IGNORE_STATE)')
-parser.add_argument('-conf', '--config', default=False, action='store_true', help='Open config file')
-parser.add_argument('--state', default=False, action='store_true', help='Open state file')
-parser.add_argument('-ni', '--noinstall', default=False, const=True, action='store_const', help='Create itslearning-dl folder in Documents')
-default_logfile_bool = conf.get_param("ITSLEARNINGDL_LOGFILE") or True
-parser.add_argument('-lf', '--logfile', default=default_logfile_bool, const=True, action='store_const', help=f'Create log file (default: {default_logfile_bool})')
-default_worker_count = conf.get_param("WORKER_COUNT") or 20
-parser.add_argument('-w', '--worker', type=int, default=default_worker_count, help=f'Number of worker processes to use for downloading (default: {default_worker_count})')
-parser.add_argument('--instance', type=str, default=conf.get_param("ITSLEARNING_INSTANCE"), help='Set the Itslearning API instance (default: Config > ITSLEARNING_INSTANCE)')
-default_log_level = conf.get_param("LOGLVL") or "info"
-parser.add_argument("--loglvl", choices=["debug", "info", "warning", "error", "critical"], default=default_log_level, help="Set the logging level (default: info)")
-
-# Parse the arguments
-args = parser.parse_args()
-
 # Other variables
-access_token = ""
-resources = []  # Create a resources "queue"
+default_account = None  # The account of the arguments, or of a pool worker
+accounts = []  # All accounts synced by this process
+account_local = threading.local()
+dedup_store = None
+resources = []  # Collected resources for the pool engine
 
 # Set up logging with colored output
 LOG_COLORS = {
@@ -73,7 +62,7 @@ class ColoredFormatter(logging.Formatter):
 logger = logging.getLogger()
 
 def extract_domain(url: str) -> str:
-    pattern = r"(?<=://)([A-Za-z0-9.-]+)(?=/|$)"
+    pattern = r"(?<=://)([A-Za-z0-9.-]+(?::\d+)?)(?=/|$)"
     match = re.search(pattern, url)
     if match:
         protocol = url.split("://")[0]
@@ -81,26 +70,311 @@ def extract_domain(url: str) -> str:
     else:
         return ""
 
-start_time_string = datetime.datetime.now().strftime("%d-%m-%Y %H_%M_%S")
-
-username = args.username
-password = args.password
-output_folder = args.path
-refetch = args.ignorestate
-open_conf = args.config
-open_state = args.state
-install_sys = not args.noinstall
-logfile_bool = args.logfile
-worker_count = args.worker
-itslearning_instance = extract_domain(args.instance)
+def parse_args(conf, argv=None):
+    """Parse the command line arguments with the config values as defaults."""
+    output_folder = Path(conf.get_param("ITSLEARNINGDL_OUT") or sys_path / 'out')
+    parser = argparse.ArgumentParser(description="ItsLearning-DL TOOL.")
+
+    # Define arguments
+    parser.add_argument('-u', '--username', type=str, default=conf.get_param("ITSLEARNING_USERNAME"), help='Set your Itslearning username (default: Config > ITSLEARNING_USERNAME)')
+    parser.add_argument('-p', '--password', type=str, default=conf.get_param("ITSLEARNING_PASSWORD"), help='Set your Itslearning password (default: Config > ITSLEARNING_PASSWORD)')
+    parser.add_argument('-o', '--path', type=str, default=output_folder, help=f'Set the output folder for downloaded resources (default: Config > ITSLEARNINGDL_OUT): {output_folder})')
+    default_ignore_state = conf.get_param("IGNORE_STATE") or False
+    parser.add_argument('-a', '--ignorestate', default=default_ignore_state, const=True, action='store_const', help='Force refetch of all elements (IGNORE_STATE)')
+    parser.add_argument('-conf', '--config', default=False, action='store_true', help='Open config file')
+    parser.add_argument('--state', default=False, action='store_true', help='Open state file')
+    default_state_backend = conf.get_param("STATE_BACKEND") or "sqlite"
+    parser.add_argument('--statebackend', choices=["sqlite", "json"], default=default_state_backend, help=f'Set the state backend (default: {default_state_backend})')
+    parser.add_argument('-ni', '--noinstall', default=False, const=True, action='store_const', help='Create itslearning-dl folder in Documents')
+    default_logfile_bool = conf.get_param("ITSLEARNINGDL_LOGFILE") or True
+    parser.add_argument('-lf', '--logfile', default=default_logfile_bool, const=True, action='store_const', help=f'Create log file (default: {default_logfile_bool})')
+    default_worker_count = conf.get_param("WORKER_COUNT") or 20
+    parser.add_argument('-w', '--worker', type=int, default=default_worker_count, help=f'Number of concurrent downloads (default: {default_worker_count})')
+    default_crawl_worker_count = conf.get_param("CRAWL_WORKER_COUNT") or 8
+    parser.add_argument('-cw', '--crawlworker', type=int, default=default_crawl_worker_count, help=f'Number of concurrent folder requests while crawling (default: {default_crawl_worker_count})')
+    default_page_size = conf.get_param("PAGE_SIZE") or 100
+    parser.add_argument('--pagesize', type=int, default=default_page_size, help=f'Entries per page of the course and folder listings (default: {default_page_size})')
+    default_page_prefetch = conf.get_param("PAGE_PREFETCH")
+    default_page_prefetch = 1 if default_page_prefetch is None else default_page_prefetch
+    parser.add_argument('--pageprefetch', type=int, default=default_page_prefetch, help=f'Pages of a listing requested ahead while one is handled, 0 to disable (default: {default_page_prefetch})')
+    default_chunk_size = conf.get_param("CHUNK_SIZE") or 1024 * 1024
+    parser.add_argument('-cs', '--chunksize', type=int, default=default_chunk_size, help=f'Chunk size in bytes for writing downloads (default: {default_chunk_size})')
+    default_segment_size = conf.get_param("SEGMENT_SIZE")
+    default_segment_size = 32 * 1024 * 1024 if default_segment_size is None else default_segment_size
+    parser.add_argument('--segmentsize', type=int, default=default_segment_size, help=f'Download files larger than this many bytes in parallel ranged segments, 0 to disable (default: {default_segment_size})')
+    default_segment_count = conf.get_param("SEGMENTS") or 4
+    parser.add_argument('--segments', type=int, default=default_segment_count, help=f'Maximum number of parallel segments of a large file (default: {default_segment_count})')
+    default_resolution_ttl = conf.get_param("RESOLUTION_TTL")
+    default_resolution_ttl = 7 * 24 * 3600 if default_resolution_ttl is None else default_resolution_ttl
+    parser.add_argument('--resolutionttl', type=int, default=default_resolution_ttl, help=f'Seconds to reuse the resolved download location of an element, 0 to disable (default: {default_resolution_ttl})')
+    default_html_extractor = conf.get_param("HTML_EXTRACTOR") or "auto"
+    parser.add_argument('--htmlextractor', choices=["auto", *EXTRACTORS], default=default_html_extractor, help=f'HTML extractor for the SSO and iframe pages (default: {default_html_extractor})')
+    default_max_retries = conf.get_param("MAX_RETRIES")
+    default_max_retries = 4 if default_max_retries is None else default_max_retries
+    parser.add_argument('--retries', type=int, default=default_max_retries, help=f'Retries of a failed or throttled request with backoff (default: {default_max_retries})')
+    default_request_timeout = conf.get_param("REQUEST_TIMEOUT") or 30
+    parser.add_argument('--timeout', type=float, default=default_request_timeout, help=f'Read timeout of a request in seconds (default: {default_request_timeout})')
+    parser.add_argument('--metrics', type=str, default=conf.get_param("METRICS_FILE"), help='Write metrics of the run to this file, Prometheus format for .prom, otherwise JSON (default: Config > METRICS_FILE)')
+    default_token_cache = conf.get_param("TOKEN_CACHE")
+    default_token_cache = True if default_token_cache is None else default_token_cache
+    parser.add_argument('--notokencache', default=not default_token_cache, const=True, action='store_const', help=f'Log in with the password on every run instead of reusing the cached access token (default: {not default_token_cache})')
+    parser.add_argument('--dedupstore', type=str, default=conf.get_param("DEDUP_STORE"), help='Keep every file once in this folder and hardlink it into the courses, best on the file system of the output folder (default: Config > DEDUP_STORE)')
+    parser.add_argument('--watch', default=False, action='store_true', help='Keep running and poll the courses for changes, stop with SIGINT or SIGTERM')
+    default_watch_interval = conf.get_param("WATCH_INTERVAL") or 900
+    parser.add_argument('--interval', type=float, default=default_watch_interval, help=f'Seconds between the polls of the watch mode (default: {default_watch_interval})')
+    default_watch_jitter = conf.get_param("WATCH_JITTER")
+    default_watch_jitter = 0.1 if default_watch_jitter is None else default_watch_jitter
+    parser.add_argument('--jitter', type=float, default=default_watch_jitter, help=f'Random share the poll interval varies by (default: {default_watch_jitter})')
+    default_engine = conf.get_param("DOWNLOAD_ENGINE") or "async"
+    parser.add_argument('-e', '--engine', choices=["async", "pool"], default=default_engine, help=f'Download engine: asyncio with a shared connection pool or a process pool (default: {default_engine})')
+    parser.add_argument('--instance', type=str, default=conf.get_param("ITSLEARNING_INSTANCE"), help='Set the Itslearning API instance (default: Config > ITSLEARNING_INSTANCE)')
+    default_log_level = conf.get_param("LOGLVL") or "info"
+    parser.add_argument("--loglvl", choices=["debug", "info", "warning", "error", "critical"], default=default_log_level, help="Set the logging level (default: info)")
+    parser.add_argument('--retry-failed', default=False, action='store_true', help='Only download the elements that failed before, without crawling')
+    default_failure_retry_limit = conf.get_param("FAILURE_RETRY_LIMIT") or 5
+    parser.add_argument('--failurelimit', type=int, default=default_failure_retry_limit, help=f'Failed attempts after which an element is only retried with --retry-failed (default: {default_failure_retry_limit})')
+    parser.add_argument('--account', action='append', default=[], metavar='NAME', help='Only sync this account of the ACCOUNTS in the config; repeatable (default: all)')
+    parser.add_argument('--include-course', action='append', default=list(conf.get_param("INCLUDE_COURSES") or []), metavar='COURSE', help='Only crawl this course, by ID or title glob; repeatable, added to INCLUDE_COURSES')
+    parser.add_argument('--exclude-course', action='append', default=list(conf.get_param("EXCLUDE_COURSES") or []), metavar='COURSE', help='Skip this course, by ID or title glob; repeatable, added to EXCLUDE_COURSES')
+    parser.add_argument('--include-path', action='append', default=list(conf.get_param("INCLUDE_PATHS") or []), metavar='GLOB', help='Only crawl the folders and elements matching this path glob; repeatable, added to INCLUDE_PATHS')
+    parser.add_argument('--exclude-path', action='append', default=list(conf.get_param("EXCLUDE_PATHS") or []), metavar='GLOB', help='Skip the folders and elements matching this path glob; repeatable, added to EXCLUDE_PATHS')
+    parser.add_argument('--element-type', action='append', default=list(conf.get_param("ELEMENT_TYPES") or []), metavar='TYPE', help='Only crawl resources of this ElementType, e.g. Folder; repeatable, added to ELEMENT_TYPES (default: all)')
+    default_max_file_size = conf.get_param("MAX_FILE_SIZE") or 0
+    default_folder_pruning = bool(conf.get_param("FOLDER_PRUNING"))
+    parser.add_argument('--prune-folders', dest='prune_folders', default=default_folder_pruning, const=True, action='store_const', help=f'Take the folders of a changed course with an unchanged LastUpdatedUtc from the snapshot instead of requesting them; misses changes unless itslearning updates the LastUpdatedUtc of every parent folder (default: {default_folder_pruning})')
+    parser.add_argument('--full-crawl', dest='prune_folders', const=False, action='store_const', help=f'Request every folder of a changed course, also with FOLDER_PRUNING (default: {not default_folder_pruning})')
+    parser.add_argument('--maxfilesize', type=int, default=default_max_file_size, help=f'Skip files larger than this many bytes, 0 for no limit (default: {default_max_file_size})')
+    parser.add_argument('--verify', nargs='?', const='quick', choices=['quick', 'full'], help='Only check the downloaded files against the state without network access and queue missing or corrupted ones; quick hashes only files with a changed mtime, full hashes all (default: quick)')
+    parser.add_argument('--plan-only', type=str, metavar='PLAN', help='Only crawl all courses and write their file resources as JSON lines to PLAN, without downloading')
+    parser.add_argument('--plan', type=str, help='Download the resources of a plan written by --plan-only instead of crawling')
+    parser.add_argument('--shard', type=str, default="0/1", metavar='I/N', help='Only download the I-th of N disjoint parts of the plan, counted from 0 (default: 0/1)')
+
+    args = parser.parse_args(argv)
+    try:
+        parse_shard(args.shard)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.shard != "0/1" and not args.plan:
+        parser.error("--shard needs --plan")
+    if args.plan_only and (args.plan or args.watch):
+        parser.error("--plan-only can't be combined with --plan or --watch")
+    if args.plan and args.watch:
+        parser.error("--plan can't be combined with --watch")
+    if args.retry_failed and (args.plan or args.plan_only or args.watch):
+        parser.error("--retry-failed can't be combined with --plan, --plan-only or --watch")
+    if conf.get_param("ACCOUNTS") and (args.plan or args.plan_only or args.watch):
+        parser.error("--plan, --plan-only and --watch can't be used with the ACCOUNTS of the config")
+    if args.account and not conf.get_param("ACCOUNTS"):
+        parser.error("--account needs ACCOUNTS in the config")
+    if args.verify and (args.plan or args.plan_only or args.watch or args.retry_failed or args.ignorestate):
+        parser.error("--verify can't be combined with --plan, --plan-only, --watch, --retry-failed or --ignorestate")
+    return args
+
+# Settings of a run, set by configure() and handed to the pool workers
+SETTINGS = ("username", "password", "output_folder", "refetch", "open_conf", "open_state", "state_backend",
+            "install_sys", "logfile_bool", "log_level", "worker_count", "crawl_worker_count", "page_size",
+            "page_prefetch", "chunk_size",
+            "segment_size", "segment_count", "resolution_ttl", "html_extractor_name", "max_retries", "request_timeout", "engine", "metrics_file",
+            "use_token_cache", "token_cache_path", "dedup_store_path", "watch_mode", "watch_interval", "watch_jitter",
+            "plan_only", "plan_file", "shard", "retry_failed", "failure_retry_limit", "verify_mode", "account_names",
+            "include_courses", "exclude_courses", "include_paths", "exclude_paths", "element_types", "max_file_size", "folder_pruning",
+            "itslearning_instance", "page_host", "resource_host")
+
+username = None
+password = None
+output_folder = None
+refetch = False
+open_conf = False
+open_state = False
+state_backend = "sqlite"
+install_sys = True
+logfile_bool = True
+log_level = "info"
+worker_count = 20
+crawl_worker_count = 8
+page_size = 100
+page_prefetch = 1
+chunk_size = 1024 * 1024
+segment_size = 32 * 1024 * 1024
+segment_count = 4
+resolution_ttl = 7 * 24 * 3600
+html_extractor_name = "auto"
+html_extractor = None
+max_retries = 4
+request_timeout = 30
+engine = "async"
+metrics_file = None
+use_token_cache = True
+token_cache_path = None
+dedup_store_path = None
+watch_mode = False
+watch_interval = 900
+watch_jitter = 0.1
+plan_only = None
+plan_file = None
+shard = (0, 1)
+retry_failed = False
+failure_retry_limit = 5
+verify_mode = None
+account_names = []
+include_courses = []
+exclude_courses = []
+include_paths = []
+exclude_paths = []
+element_types = []
+max_file_size = 0
+folder_pruning = False
+crawl_filter = None
+itslearning_instance = ""
+page_host = ""
+resource_host = ""
+
+def configure(conf, args):
+    """Set the settings of this run from the config and the parsed arguments."""
+    global username, password, output_folder, refetch, open_conf, open_state, state_backend, install_sys
+    global logfile_bool, log_level, worker_count, crawl_worker_count, chunk_size, resolution_ttl, html_extractor_name
+    global segment_size, segment_count, page_size, page_prefetch
+    global max_retries, request_timeout, engine, metrics_file, use_token_cache, dedup_store_path, itslearning_instance
+    global watch_mode, watch_interval, watch_jitter, plan_only, plan_file, shard, retry_failed, failure_retry_limit
+    global verify_mode, account_names, include_courses, exclude_courses, include_paths, exclude_paths, element_types, max_file_size
+    global folder_pruning, page_host, resource_host
+    username = args.username
+    password = args.password
+    output_folder = args.path
+    refetch = args.ignorestate
+    open_conf = args.config
+    open_state = args.state
+    state_backend = args.statebackend
+    install_sys = not args.noinstall
+    logfile_bool = args.logfile
+    log_level = args.loglvl
+    worker_count = args.worker
+    crawl_worker_count = args.crawlworker
+    page_size = max(args.pagesize, 1)
+    page_prefetch = max(args.pageprefetch, 0)
+    chunk_size = args.chunksize
+    segment_size = args.segmentsize
+    segment_count = max(args.segments, 1)
+    resolution_ttl = args.resolutionttl
+    html_extractor_name = args.htmlextractor
+    max_retries = args.retries
+    request_timeout = args.timeout
+    engine = args.engine
+    metrics_file = args.metrics
+    use_token_cache = not args.notokencache
+    dedup_store_path = args.dedupstore
+    watch_mode = args.watch
+    watch_interval = args.interval
+    watch_jitter = min(max(args.jitter, 0), 1)
+    plan_only = args.plan_only
+    plan_file = args.plan
+    shard = parse_shard(args.shard)
+    retry_failed = args.retry_failed
+    failure_retry_limit = args.failurelimit
+    verify_mode = args.verify
+    account_names = args.account
+    include_courses = args.include_course
+    exclude_courses = args.exclude_course
+    include_paths = args.include_path
+    exclude_paths = args.exclude_path
+    element_types = args.element_type
+    max_file_size = args.maxfilesize
+    folder_pruning = args.prune_folders
+    itslearning_instance = extract_domain(args.instance or "")
+    # Hosts of the file pages and downloads (only changed to test against a local server)
+    page_host = extract_domain(conf.get_param("ITSLEARNING_PAGE_HOST") or "https://page.itslearning.com")
+    resource_host = extract_domain(conf.get_param("ITSLEARNING_RESOURCE_HOST") or "https://resource.itslearning.com")
+
+def make_default_account():
+    """The account of the username, password, instance and output arguments."""
+    return Account("default", username, password, itslearning_instance, page_host, resource_host, output_folder, sys_path, token_cache_path)
+
+def get_accounts(conf):
+    """Get the accounts of the ACCOUNTS list of the config, limited to --account if given.
+
+    Every entry takes the keys of a single account (ITSLEARNING_USERNAME,
+    ITSLEARNING_PASSWORD, ITSLEARNING_INSTANCE, ITSLEARNING_PAGE_HOST,
+    ITSLEARNING_RESOURCE_HOST, ITSLEARNINGDL_OUT) and a NAME; missing hosts
+    default to the ones of the config. Its state is kept in accounts/<NAME>
+    of the itslearning-dl folder and its files in <output folder>/<NAME>
+    unless ITSLEARNINGDL_OUT is set.
+    """
+    selected = []
+    names = set()
+    for index, entry in enumerate(conf.get_param("ACCOUNTS") or []):
+        name = str(entry.get("NAME") or entry.get("ITSLEARNING_USERNAME") or index + 1)
+        if name in names:
+            raise Exception(f"Duplicate account name '{name}' in ACCOUNTS")
+        names.add(name)
+        if account_names and name not in account_names:
+            continue
+        state_dir = sys_path / "accounts" / account_folder(name)
+        selected.append(Account(name, entry.get("ITSLEARNING_USERNAME"), entry.get("ITSLEARNING_PASSWORD"),
+                                extract_domain(entry.get("ITSLEARNING_INSTANCE") or "") or itslearning_instance,
+                                extract_domain(entry.get("ITSLEARNING_PAGE_HOST") or "") or page_host,
+                                extract_domain(entry.get("ITSLEARNING_RESOURCE_HOST") or "") or resource_host,
+                                entry.get("ITSLEARNINGDL_OUT") or os.path.join(output_folder, account_folder(name)),
+                                state_dir, str(state_dir / "token.json") if use_token_cache and (install_sys or state_dir.exists()) else None))
+    unknown = set(account_names) - names
+    if unknown:
+        raise Exception(f"Unknown accounts: {', '.join(sorted(unknown))}")
+    return selected
+
+def current_account():
+    """Get the account the current thread works for."""
+    return getattr(account_local, "account", None) or default_account
+
+def run_as(account, function, *args):
+    """Call a function for an account, e.g. on a thread of an executor that all accounts share."""
+    previous = getattr(account_local, "account", None)
+    account_local.account = account
+    try:
+        return function(*args)
+    finally:
+        account_local.account = previous
+
+def get_settings():
+    """Picklable settings of this run for the pool workers."""
+    return {name: globals()[name] for name in SETTINGS}
+
+def get_crawl_filter():
+    """Get the compiled include and exclude rules of this process."""
+    global crawl_filter
+    if crawl_filter is None:
+        crawl_filter = CrawlFilter(include_courses, exclude_courses, include_paths, exclude_paths, element_types)
+    return crawl_filter
+
+def get_html_extractor():
+    """Get the HTML extractor of this process, created on first use."""
+    global html_extractor
+    if html_extractor is None:
+        html_extractor = get_extractor(html_extractor_name)
+    return html_extractor
+
 user_agent = "com.itslearning.itslearningintapp 3.7.1 (HONOR BLN-L21 / Android 9)"
 
 headers = {
     "User-Agent": user_agent
 }
 
-# Global variable for the Pool
+# Global variables for the Pool and the asyncio engine executor
 pool = None
+executor = None
+
+# Set by SIGINT or SIGTERM in the watch mode
+stop_requested = threading.Event()
+
+class StopRequested(Exception):
+    pass
+
+# Keep-alive sessions of this process
+session_pool = None
+session_pool_lock = threading.Lock()
+
+# Concurrency limits, retries and backoff of all requests of this process
+scheduler = None
+# Threads that request the next pages of the listings ahead
+page_executor = None
 
 def signal_handler(sig, frame):
     global pool, resources
@@ -109,32 +383,114 @@ def signal_handler(sig, frame):
     if pool is not None:
         logging.warning("Try stopping download processes.")
         pool.terminate()
+    if executor is not None:
+        logging.warning("Try stopping download tasks.")
+        executor.shutdown(wait=False, cancel_futures=True)
     logging.warning("Exit process")
     sys.exit()
 
-def remove_state_file():
-    logging.info("Remove state.json to download all elements")
-    os.remove(state_path)
-
-# Login with username and password to get an authtoken
-def get_access_token(username, password):
-    url = itslearning_instance + "/restapi/oauth2/token"
-    payload = f"client_id=10ae9d30-1853-48ff-81cb-47b58a325685&grant_type=password&username={quote_plus(username)}&password={quote_plus(password)}"
+def request_token(account, grant):
+    """Send an OAuth grant; returns the token response, None if it was rejected."""
+    url = account.instance + "/restapi/oauth2/token"
+    payload = "client_id=10ae9d30-1853-48ff-81cb-47b58a325685&" + "&".join(f"{name}={quote_plus(value)}" for name, value in grant.items())
     headers = {
         "Content-Type": "application/x-www-form-urlencoded",
         "User-Agent": user_agent
     }
 
+    import requests
     try:
-        response = requests.post(url, data=payload, headers=headers, timeout=5)
+        response = http_request("POST", url, data=payload, headers=headers)
         if response.status_code == 200:
-            return response.json()["access_token"]
-        else:
-            return None
-    except requests.RequestException as e:
+            return response.json()
+        logging.debug(f"Token request ({grant['grant_type']}) failed with status {response.status_code}")
+        return None
+    except (requests.RequestException, ValueError) as e:
         logging.error(f"Login request exception: {e}")
         return None
 
+def get_token_cache(account):
+    if account.token_cache is None:
+        account.token_cache = TokenCache(account.token_cache_path)
+    return account.token_cache
+
+def login(account, previous=None):
+    """Refresh the previous token, or log in with username and password if that fails."""
+    response = None
+    if previous and previous.get("refresh_token"):
+        logging.debug("-> Refresh access token")
+        response = request_token(account, {"grant_type": "refresh_token", "refresh_token": previous["refresh_token"]})
+    if response is None:
+        logging.debug("-> Login with password")
+        response = request_token(account, {"grant_type": "password", "username": account.username, "password": account.password})
+    if response is None:
+        return None
+    return get_token_cache(account).save(account.instance, account.username, response)
+
+# Get an authtoken, from the cache if it is still valid
+def get_access_token(account):
+    with account.token_lock:
+        cached = get_token_cache(account).load(account.instance, account.username)
+        if is_token_valid(cached):
+            logging.debug("-> Cached access token")
+            account.token = cached
+        else:
+            account.token = login(account, cached)
+        account.access_token = account.token["access_token"] if account.token else None
+        return account.access_token
+
+def refresh_access_token(account, rejected):
+    """Replace an access token the server rejected.
+
+    The first thread refreshes it, the others wait and use the new token. A
+    token refreshed by another process (pool engine) is taken from the cache.
+    """
+    with account.token_lock:
+        if account.access_token != rejected:
+            return account.access_token
+        cached = get_token_cache(account).load(account.instance, account.username)
+        if is_token_valid(cached) and cached["access_token"] != rejected:
+            account.token = cached
+        else:
+            account.token = login(account, account.token)
+        if account.token is None:
+            raise Exception("Refreshing the access token failed")
+        account.access_token = account.token["access_token"]
+        logging.info("-> Refreshed the access token")
+        return account.access_token
+
+def api_request(url, session=None, params=None, **kwargs):
+    """GET an API endpoint with the access token; refreshes the token once if it was rejected."""
+    account = current_account()
+    used_token = account.access_token
+    response = http_request("GET", url, session, params=dict(params or {}, access_token=used_token), **kwargs)
+    if response.status_code == 401:
+        response.close()
+        new_token = refresh_access_token(account, used_token)
+        response = http_request("GET", url, session, params=dict(params or {}, access_token=new_token), **kwargs)
+    return response
+
+def get_session():
+    """Get the keep-alive session of the current thread for its account."""
+    global session_pool
+    with session_pool_lock:
+        if session_pool is None:
+            from session_pool import SessionPool
+            # Every download (and segment), crawl and page thread may hold a connection to the same host
+            session_pool = SessionPool(headers, pool_maxsize=worker_count * segment_count + crawl_worker_count * 2)
+    return session_pool.get(current_account().name)
+
+def http_request(method, url, session=None, **kwargs):
+    """Send a request through the scheduler, by default on the session of the current thread."""
+    global scheduler
+    with session_pool_lock:
+        if scheduler is None:
+            from request_scheduler import RequestScheduler
+            scheduler = RequestScheduler([account.instance for account in accounts], api_limit=worker_count + crawl_worker_count,
+                                         file_limit=worker_count, max_retries=max_retries, timeout=(5, request_timeout),
+                                         metrics=metrics)
+    return scheduler.request(session or get_session(), method, url, **kwargs)
+
 def extract_filename(response):
     filename = ""
     disposition = response.headers.get('Content-Disposition')
@@ -145,187 +501,1361 @@ def extract_filename(response):
             filename = matches.group(1).replace("'", "").replace('"', '')
     return unquote(filename)
 
+def account_folder(name):
+    return re.sub(r'[\\/:*?"<>|]', "_", name)
+
 def sanitize_path(raw):
     return re.sub(r'\s*?/\s*', "/", raw)
 
-def download_response(response, dest_path, filename):
-    if response.status_code != 200:
+def conditional_headers(previous):
+    """Build the conditional request headers for a previously downloaded element."""
+    request_headers = dict(headers)
+    if previous and os.path.exists(os.path.join(current_account().output_folder, previous["path"])):
+        if previous.get("etag"):
+            request_headers["If-None-Match"] = previous["etag"]
+        if previous.get("lastModified"):
+            request_headers["If-Modified-Since"] = previous["lastModified"]
+    return request_headers
+
+def is_response_unchanged(response, previous):
+    """Check whether a file response matches the previous download of the element."""
+    if not previous or not os.path.exists(os.path.join(current_account().output_folder, previous["path"])):
+        return False
+    if response.status_code == 304:
+        return True
+    # Content-Length alone is not a validator, it only confirms an ETag or Last-Modified match
+    for header, key in (("ETag", "etag"), ("Last-Modified", "lastModified")):
+        if response.headers.get(header) and previous.get(key):
+            return response.headers[header] == previous[key] and \
+                response.headers.get("Content-Length") == previous.get("contentLength")
+    return False
+
+def element_record(response, local_path, sha256, content_length):
+    """Build the state record of a downloaded element from the file response.
+
+    The size and mtime of the written file let --verify skip hashing files
+    that were not touched since.
+    """
+    stat = os.stat(os.path.join(current_account().output_folder, local_path))
+    return {
+        "etag": response.headers.get("ETag"),
+        "lastModified": response.headers.get("Last-Modified"),
+        "contentLength": content_length,
+        "path": local_path,
+        "sha256": sha256,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime
+    }
+
+def part_validator(response):
+    """Validator of a file response that ties a .part file to its version, None if the response has none."""
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return {"etag": etag}
+    last_modified = response.headers.get("Last-Modified")
+    return {"lastModified": last_modified} if last_modified else None
+
+def read_part_validator(part_path):
+    try:
+        with open(part_path + ".validator", "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_part_validator(part_path, validator):
+    if validator is None:
+        remove_part_validator(part_path)
+        return
+    with open(part_path + ".validator", "w") as f:
+        json.dump(validator, f)
+
+def remove_part_validator(part_path):
+    if os.path.exists(part_path + ".validator"):
+        os.remove(part_path + ".validator")
+
+def discard_part(part_path):
+    """Remove a .part file and its validator."""
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    remove_part_validator(part_path)
+
+def is_resumable(response, validator):
+    """Check whether a response continues the version of a .part file.
+
+    416 means the .part file is complete already or longer than the file,
+    a 206 with another validator belongs to a newer version (a server that
+    ignored If-Range); a 200 restarts the transfer anyway.
+    """
+    if response.status_code == 416:
+        return False
+    return response.status_code != 206 or part_validator(response) == validator
+
+def download_file(session, url, dest_path, filename, previous, params=None, cached=False, named=False):
+    """Fetch a file unless it is unchanged and return its element record.
+
+    An interrupted earlier transfer of the file is resumed with a Range
+    request; If-Range with the validator stored next to the .part file makes
+    sure only the same version of the file is continued.
+    With a cached resolution an HTML page (e.g. a login page because the SSO
+    cookies are missing) is treated as a failure instead of as the file.
+    named (a file of a multi-file element) keeps the file and its .part under
+    filename, unique in the element, and returns the name from the
+    Content-Disposition in "name"; name_element_files moves it there.
+    """
+    part_path = os.path.join(current_account().output_folder, dest_path.lstrip('/'), filename) + ".part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    validator = read_part_validator(part_path) if offset else None
+    if offset and validator is None:
+        # The version of the .part file is unknown, so it can't be continued safely
+        logging.debug(f" > discard .part without validator: {filename}")
+        discard_part(part_path)
+        offset = 0
+    request_headers = conditional_headers(previous)
+    if offset:
+        request_headers["Range"] = f"bytes={offset}-"
+        request_headers["If-Range"] = validator.get("etag") or validator["lastModified"]
+    file_response = http_request("GET", url, session, headers=request_headers, params=params, stream=True)
+    if offset and not is_resumable(file_response, validator):
+        logging.debug(f" > discard .part (status {file_response.status_code}): {filename}")
+        file_response.close()
+        discard_part(part_path)
+        return download_file(session, url, dest_path, filename, previous, params, cached, named)
+    with file_response:
+        if cached and file_response.headers.get("Content-Type", "").startswith("text/html"):
+            raise Exception(f"Got a HTML page instead of the file: {file_response.url}")
+        if is_response_unchanged(file_response, previous):
+            logging.debug(f" > unchanged: {filename}")
+            if offset:
+                discard_part(part_path)
+            return dict(previous, unchanged=True)
+        size = expected_size(file_response, offset)
+        if max_file_size and size is not None and size > max_file_size:
+            logging.debug(f" > too large: {filename}")
+            return {"skipped": f"{size} bytes is more than the maximum file size of {max_file_size} bytes"}
+        validator = blob_key(file_response) if get_dedup_store() is not None else None
+        sha256 = dedup_store.lookup(validator) if validator else None
+        if sha256 is not None:
+            # The same file was downloaded before, e.g. in another course
+            logging.debug(f" > stored already: {filename}")
+            if offset:
+                discard_part(part_path)
+            local_path, content_length = place_blob(sha256, dest_path, filename)
+            metrics.inc("itslearning_dl_dedup_total", result="skipped")
+            metrics.inc("itslearning_dl_dedup_bytes_total", int(content_length))
+        else:
+            local_path, sha256, content_length = download_response(file_response, dest_path, filename, offset, validator, session)
+        record = element_record(file_response, local_path, sha256, content_length)
+        if named:
+            record["name"] = os.path.basename(extract_filename(file_response).strip())
+        return record
+
+def get_dedup_store():
+    """Get the blob store of this process, None if deduplication is off."""
+    global dedup_store
+    if dedup_store is None and dedup_store_path:
+        dedup_store = BlobStore(dedup_store_path)
+    return dedup_store
+
+def place_blob(sha256, dest_path, filename):
+    """Link a stored file into the output folder; returns the relative path and the size."""
+    dest_path = dest_path.lstrip('/')
+    Path(current_account().output_folder, dest_path).mkdir(parents=True, exist_ok=True)
+    full_file_path = os.path.join(current_account().output_folder, dest_path, filename)
+    dedup_store.place(sha256, full_file_path)
+    return os.path.join(dest_path, filename), str(os.path.getsize(full_file_path))
+
+def expected_size(response, offset):
+    """Get the complete file size announced by a (partial) response, if known."""
+    if response.headers.get("Content-Encoding", "identity") != "identity":
+        # The body is decoded while streaming, so the sizes don't match
+        return None
+    if response.status_code == 206:
+        match = re.match(r"bytes (\d+)-\d+/(\d+)", response.headers.get("Content-Range", ""))
+        if not match or int(match.group(1)) != offset:
+            raise Exception(f"DL - failed. Unexpected Content-Range: {response.headers.get('Content-Range')}")
+        return int(match.group(2))
+    length = response.headers.get("Content-Length")
+    return int(length) if length and length.isdigit() else None
+
+def segment_plan(response, offset, size):
+    """Byte ranges to fetch a file in parallel, None to stream it in one piece.
+
+    Only complete responses of large files whose host accepts byte ranges are
+    split; a compressed body has no byte ranges of the file, and a response
+    without a validator can't tie the segments to its version.
+    """
+    if not segment_size or segment_count < 2 or offset or size is None or size <= segment_size:
+        return None
+    if response.status_code != 200 or response.headers.get("Accept-Ranges", "").lower() != "bytes":
+        return None
+    if part_validator(response) is None:
+        return None
+    segments = min(segment_count, -(-size // segment_size))
+    bounds = [size * index // segments for index in range(segments + 1)]
+    return [(bounds[index], bounds[index + 1] - 1) for index in range(segments)]
+
+def download_segment(session, response, path, size, start, end):
+    """Fetch the bytes start-end (inclusive) of a file into path; returns the number of bytes written.
+
+    The ranges are requested with If-Range on the validator of the first
+    response, so a file that changed in between fails the download instead of
+    mixing the bytes of two versions.
+    """
+    if start == 0:
+        # The first segment is the beginning of the response that is already open
+        source = response
+    else:
+        validator = part_validator(response)
+        headers = {"Range": f"bytes={start}-{end}", "If-Range": validator.get("etag") or validator["lastModified"]}
+        source = http_request("GET", response.url, session, headers=headers, stream=True)
+    with source:
+        if source is not response:
+            content_range = source.headers.get("Content-Range", "")
+            if source.status_code != 206 or content_range != f"bytes {start}-{end}/{size}":
+                raise Exception(f"DL - failed. Segment {start}-{end} got status {source.status_code}, Content-Range: {content_range}")
+        remaining = end + 1 - start
+        with open(path, 'r+b') as f:
+            f.seek(start)
+            for chunk in source.iter_content(chunk_size=chunk_size):
+                chunk = chunk[:remaining]
+                f.write(chunk)
+                remaining -= len(chunk)
+                if not remaining:
+                    break
+    if remaining:
+        raise Exception(f"DL - incomplete. Segment {start}-{end} is missing {remaining} bytes")
+    return end + 1 - start
+
+def download_segments(session, response, part_path, size, segments):
+    """Fetch the segments of a file in parallel into the .part file.
+
+    The segments are written into a preallocated .seg file that only becomes
+    the .part file when all of them are complete, as a resume only continues
+    after the end of the .part file.
+    """
+    seg_path = part_path + ".seg"
+    with open(seg_path, 'wb') as f:
+        f.truncate(size)
+    try:
+        with ThreadPoolExecutor(max_workers=len(segments) - 1, thread_name_prefix="segment") as segment_executor:
+            futures = [segment_executor.submit(download_segment, session, response, seg_path, size, start, end)
+                       for start, end in segments[1:]]
+            download_segment(session, response, seg_path, size, *segments[0])
+            for future in futures:
+                future.result()
+    except BaseException:
+        os.remove(seg_path)
+        raise
+    os.replace(seg_path, part_path)
+    metrics.inc("itslearning_dl_segmented_total")
+
+def download_response(response, dest_path, filename, offset=0, validator=None, session=None):
+    """Stream the response into a .part file and move it into place when complete.
+
+    The .part file is kept when the transfer fails, so the next attempt can
+    resume from it. Large files are fetched in parallel ranged segments if
+    the host supports it. With deduplication the file is moved into the blob
+    store (under the validator key of the response) and linked into place.
+    Returns the relative path, the sha256 and the file size.
+    """
+    if response.status_code == 206 and offset:
+        mode = 'ab'
+    elif response.status_code == 200:
+        mode, offset = 'wb', 0
+    else:
         raise Exception(f"DL - failed. Status code: {response.status_code}; File: {filename}")
     try:
         dest_path = dest_path.lstrip('/')
-        full_dir_path = os.path.join(output_folder, dest_path)
+        full_dir_path = os.path.join(current_account().output_folder, dest_path)
         full_file_path = os.path.join(full_dir_path, filename)
+        part_path = full_file_path + ".part"
         Path(full_dir_path).mkdir(parents=True, exist_ok=True)
         logging.debug("-> DL File")
         logging.debug(f" > status: {response.status_code}")
         logging.debug(f" > filename: {filename}")
         logging.debug(f" > full_dir_path: {full_dir_path}")
         logging.debug(f" > full_file_path: {full_file_path}")
-
-        if response.status_code == 200:
-            with open(full_file_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=1024):
+        logging.debug(f" > resume offset: {offset}")
+
+        size = expected_size(response, offset)
+        if not offset:
+            write_part_validator(part_path, part_validator(response))
+        segments = segment_plan(response, offset, size) if session is not None else None
+        file_hash = hashlib.sha256()
+        if segments:
+            logging.debug(f" > {len(segments)} segments")
+            with metrics.timer("transfer"):
+                download_segments(session, response, part_path, size, segments)
+        if offset or segments:
+            # Hash the part that was transferred before; segments arrive out of order
+            with open(part_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    file_hash.update(chunk)
+        if not segments:
+            with metrics.timer("transfer"), open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
                     if chunk:
                         f.write(chunk)
+                        file_hash.update(chunk)
+        written = os.path.getsize(part_path)
+        metrics.inc("itslearning_dl_bytes_total", written - offset, host=urlparse(response.url).netloc)
+        if size is not None and written != size:
+            raise Exception(f"DL - incomplete. {written} of {size} bytes; File: {filename}")
+        sha256 = file_hash.hexdigest()
+        if get_dedup_store() is None:
+            os.replace(part_path, full_file_path)
+        else:
+            if not dedup_store.add(part_path, sha256, validator):
+                metrics.inc("itslearning_dl_dedup_total", result="duplicate")
+                metrics.inc("itslearning_dl_dedup_bytes_total", written)
+            dedup_store.place(sha256, full_file_path)
+        remove_part_validator(part_path)
+        return os.path.join(dest_path, filename), sha256, str(size if size is not None else written)
     except Exception as e:
         logging.error(f"Error: {e}")
-        raise Exception(f" -> An error occurred while downloading the file: {filename}")
+        raise Exception(f" -> An error occurred while downloading the file: {filename}") from e
 
-def download_element(element_id, dest_path, filename, access_token):
-    url = itslearning_instance + "/restapi/personal/sso/url/v1"
+def resolve_element(session, element_id):
+    """Resolve an element through SSO and its iframe page to the location of its files."""
+    url = current_account().instance + "/restapi/personal/sso/url/v1"
     querystring = {
-        "access_token": access_token,
-        "url": itslearning_instance + "/LearningToolElement/ViewLearningToolElement.aspx?LearningToolElementId=" + str(element_id)
+        "url": current_account().instance + "/LearningToolElement/ViewLearningToolElement.aspx?LearningToolElementId=" + str(element_id)
     }
 
-    response = requests.request("GET", url, headers=headers, params=querystring, timeout=5)
+    with metrics.timer("sso_resolve"):
+        response = api_request(url, session, headers=headers, params=querystring)
 
-    logging.debug(response)
+        logging.debug(response)
 
-    if 'Url' in response.json():
-        sso_url = response.json()["Url"]
-    else:
-        raise Exception('Url not found in the response')
+        if 'Url' in response.json():
+            sso_url = response.json()["Url"]
+        else:
+            raise Exception('Url not found in the response')
 
-    logging.debug("-> SSO")
-    session = requests.Session()
+        logging.debug("-> SSO")
 
-    response = session.request("GET", sso_url, headers=headers, timeout=5)
+        response = http_request("GET", sso_url, session, headers=headers)
 
     logging.debug("-> Iframe")
 
-    soup = BeautifulSoup(response.text, 'html.parser')
-    iframe_src = soup.find("iframe").get("src")
+    with metrics.timer("iframe_fetch"):
+        iframe_src = get_html_extractor().iframe_src(response.text)
+        if iframe_src is None:
+            raise Exception('Iframe not found in the SSO page')
 
-    response2 = session.request("GET", iframe_src, headers=headers, timeout=5)
+        response2 = http_request("GET", iframe_src, session, headers=headers)
 
-    logging.debug("-> Redirect")
+        logging.debug("-> Redirect")
 
-    soup2 = BeautifulSoup(response2.text, "html.parser")
-    link_elements = soup2.select(".ilw-filesblock-li a")
+        link_elements = get_html_extractor().file_links(response2.text)
     if link_elements:
         logging.debug(" > link_elements: true")
-        for element in link_elements:
-            url = "https://page.itslearning.com" + element.get("href")
-
-            file_response = session.request("GET", url, headers=headers, timeout=5)
-            download_response(file_response, dest_path, filename)
+        return {"urls": [current_account().page_host + href for href in link_elements]}
 
-    else:
-        logging.debug(" > link_elements: false")
-        url = urlparse(response2.url)
-        qs = parse_qs(url.query)
-        params = {
+    logging.debug(" > link_elements: false")
+    url = urlparse(response2.url)
+    qs = parse_qs(url.query)
+    return {
+        "params": {
             "LearningObjectId": qs["LearningObjectId"],
             "LearningObjectInstanceId": qs["LearningObjectInstanceId"]
         }
+    }
 
-        url = "https://resource.itslearning.com/Proxy/DownloadRedirect.ashx"
-        file_response = session.request("GET", url, headers=headers, params=params, timeout=5)
-        download_response(file_response, dest_path, filename)
-
-def query_course_list():
+def remove_element_file(dest_path, filename):
+    """Remove the file of an element that has several files now, as they go into a folder of the same name.
+
+    Returns whether there was such a file.
+    """
+    path = os.path.join(current_account().output_folder, dest_path.lstrip('/'), filename)
+    discard_part(path + ".part")
+    if not os.path.isfile(path):
+        return False
+    os.remove(path)
+    logging.info(f"Removed '{path}', the element has several files now")
+    return True
+
+def remove_element_folder(dest_path, filename, file_paths):
+    """Remove the folder of an element that has a single file now, with the files recorded in it.
+
+    Returns whether there was such a folder; raises if it holds other files.
+    """
+    output = current_account().output_folder
+    path = os.path.join(output, dest_path.lstrip('/'), filename)
+    if not os.path.isdir(path):
+        return False
+    for file_path in file_paths:
+        full_path = os.path.join(output, file_path)
+        if os.path.dirname(full_path) == path and os.path.isfile(full_path):
+            os.remove(full_path)
+    for name in os.listdir(path):
+        if name.endswith(".part"):
+            discard_part(os.path.join(path, name))
     try:
-        url = itslearning_instance + "/restapi/personal/courses/v2"
-        querystring = {
-            "access_token": access_token,
-            "pageIndex": "0",
-            "pageSize": "9999",
-            "filter": "1"
-        }
-        response = requests.get(url, headers=headers, params=querystring)
-
-        # Check for HTTP errors
-        response.raise_for_status()
-
-        return response.json()["EntityArray"]
-
-    except requests.RequestException as e:
-        logger.error(f"Request failed: {e}")
-    except KeyError as ke:
-        logger.error(f"KeyError: {ke}. Check the JSON structure for 'EntityArray'")
-        # You can add more specific error handling for different exceptions if needed
+        os.rmdir(path)
+    except OSError as e:
+        raise Exception(f"The element has a single file now, but its folder holds other files: {path}") from e
+    logging.info(f"Removed '{path}', the element has a single file now")
+    return True
+
+def download_resolved(session, resolution, dest_path, filename, previous, cached, index=None, previous_files=()):
+    """Download the file of a resolved element; returns the element record.
+
+    An element with several files is not downloaded but returns the number
+    of its files, the engine downloads each of them as a task with its index
+    into the folder dest_path/filename. If the element changed between a
+    single file and several files, the old file or folder (with the
+    previous_files in it) is removed first and the record marked "replaced".
+    """
+    if "urls" in resolution and index is not None:
+        urls = resolution["urls"]
+        if index >= len(urls):
+            raise Exception(f"File {index + 1} of the element is gone, it has {len(urls)} files")
+        return download_file(session, urls[index], f"{dest_path}/{filename}", f"{filename} ({index + 1})",
+                             previous, cached=cached, named=True)
+    if "urls" in resolution and len(resolution["urls"]) > 1:
+        return {"files": len(resolution["urls"]), "replaced": remove_element_file(dest_path, filename)}
+
+    replaced = remove_element_folder(dest_path, filename, previous_files)
+    if replaced:
+        # The previous record is the one of the folder
+        previous = None
+    if "urls" in resolution:
+        record = download_file(session, resolution["urls"][0], dest_path, filename, previous, cached=cached)
+    else:
+        url = current_account().resource_host + "/Proxy/DownloadRedirect.ashx"
+        record = download_file(session, url, dest_path, filename, previous, params=resolution["params"], cached=cached)
+    return dict(record, replaced=True) if replaced else record
+
+def session_cookies(session):
+    """The unexpired cookies of a session, stored with a resolution as the file hosts need the SSO cookies."""
+    return [{"name": cookie.name, "value": cookie.value, "domain": cookie.domain, "path": cookie.path,
+             "expires": cookie.expires, "secure": cookie.secure}
+            for cookie in session.cookies if not cookie.is_expired()]
+
+def restore_cookies(session, cookies):
+    """Add the stored cookies of a resolution that a session doesn't have; returns False if one of them expired."""
+    now = time.time()
+    if any(cookie["expires"] is not None and cookie["expires"] <= now for cookie in cookies):
+        return False
+    for cookie in cookies:
+        if session.cookies.get(cookie["name"], domain=cookie["domain"], path=cookie["path"]) is None:
+            session.cookies.set(cookie["name"], cookie["value"], domain=cookie["domain"], path=cookie["path"],
+                                expires=cookie["expires"], secure=cookie["secure"])
+    return True
+
+def download_element(element_id, dest_path, filename, previous=None, resolution=None, index=None, previous_files=()):
+    """Download the file of an element, or with index one of the files of a multi-file element.
+
+    A cached resolution skips the SSO and iframe round trips, its SSO cookies
+    are restored into the session; if it fails or its cookies expired, the
+    element is resolved again. Returns the element record, the resolution and
+    whether it was freshly resolved.
+    """
+    session = get_session()
+    if resolution and not restore_cookies(session, resolution.get("cookies", [])):
+        logging.debug(" > cached resolution expired")
+    elif resolution:
+        try:
+            logging.debug("-> Cached resolution")
+            return download_resolved(session, resolution, dest_path, filename, previous, True, index, previous_files), resolution, False
+        except Exception as e:
+            logging.debug(f" > cached resolution failed: {e}")
+
+    resolution = resolve_element(session, element_id)
+    resolution["cookies"] = session_cookies(session)
+    return download_resolved(session, resolution, dest_path, filename, previous, False, index, previous_files), resolution, True
+
+def get_page_executor():
+    global page_executor
+    with session_pool_lock:
+        if page_executor is None:
+            page_executor = ThreadPoolExecutor(max_workers=max(crawl_worker_count, 1), thread_name_prefix="page")
+    return page_executor
+
+def query_pages(url, phase, params=None, wrapper=None):
+    """Yield the entities of a paged REST listing as its pages arrive.
+
+    Pages of page_size entities are requested in order; while one is
+    consumed, up to page_prefetch following pages are requested on the page
+    executor. The server may send smaller pages than requested, so a listing
+    with a Total ends once Total entities arrived, one without at a short
+    page. wrapper is the key of the page object in the response, if any.
+    """
+    params = dict(params or {}, pageSize=str(page_size))
+
+    def fetch(index):
+        with metrics.timer(phase):
+            response = api_request(url, headers=headers, params=dict(params, pageIndex=str(index)))
+            response.raise_for_status()
+            data = response.json()
+        return data[wrapper] if wrapper else data
+
+    account = current_account()
+    ahead = deque()
+    index = 0
+    next_index = 1  # The first page that was not requested yet
+    received = 0
+    data = fetch(0)
+    # The page size the server actually uses, it may cap the requested one
+    size = int(data.get("PageSize") or len(data["EntityArray"]) or page_size)
+    try:
+        while True:
+            entities = data["EntityArray"]
+            received += len(entities)
+            total = data.get("Total")
+            if total is not None:
+                page_count = -(-int(total) // size)
+                more = bool(entities) and received < int(total)
+            else:
+                page_count = None
+                more = len(entities) == size
+            while more and len(ahead) < page_prefetch and (page_count is None or next_index < page_count):
+                ahead.append(get_page_executor().submit(run_as, account, fetch, next_index))
+                next_index += 1
+            yield from entities
+            if not more:
+                return
+            index += 1
+            if ahead:
+                data = ahead.popleft().result()
+            else:
+                data = fetch(index)
+                next_index = index + 1
+    finally:
+        # The consumer stopped early or a page failed
+        for future in ahead:
+            future.cancel()
 
-    return None  # Return None or any other default value to signify failure
+def query_course_list():
+    """Yield the enrolled courses page by page."""
+    url = current_account().instance + "/restapi/personal/courses/v2"
+    return query_pages(url, "course_list", {"filter": "1"})
 
 # Fetch the resource list of a course
 def query_course_resources(course_id):
-    url = itslearning_instance + \
+    url = current_account().instance + \
         f"/restapi/personal/courses/{course_id}/resources/v1"
-    querystring = {"access_token": access_token,
-                   "pageIndex": "0", "pageSize": "9999"}
-    response = requests.request(
-        "GET", url, headers=headers, params=querystring)
-    return response.json()["Resources"]["EntityArray"]
+    return query_pages(url, "folder_crawl", wrapper="Resources")
 
 # Fetch the resource list of a subfolder
 def query_folder_resources(course_id, folder_element_id):
-    url = itslearning_instance + \
+    url = current_account().instance + \
         f"/restapi/personal/courses/{course_id}/folders/{folder_element_id}/resources/v1"
-    querystring = {"access_token": access_token,
-                   "pageIndex": "0", "pageSize": "9999"}
-    response = requests.request(
-        "GET", url, headers=headers, params=querystring)
-    return response.json()["Resources"]["EntityArray"]
+    return query_pages(url, "folder_crawl", wrapper="Resources")
 
-def download_file_resource(resource, access_token):
+def download_file_resource(resource):
+    """Download a resource and return its element record, or the error on failure.
+
+    A multi-file element returns a task per file in "files" instead, the
+    engine downloads them and merges their results (see merge_file_results).
+    """
     sanitized_path = sanitize_path(resource["Path"])
     try:
-        # Fetch the file
-        download_element(resource["ElementId"], sanitized_path, resource["Title"], access_token)
+        # Fetch the file; a file of a multi-file element is resolved through its element
+        record, resolution, resolved = download_element(resource.get("ParentId", resource["ElementId"]), sanitized_path,
+                                                        resource["Title"], resource.get("Previous"),
+                                                        resource.get("Resolution"), resource.get("FileIndex"),
+                                                        resource.get("PreviousFiles", ()))
+        if resolved:
+            resolution["lastUpdatedUtc"] = resource.get("LastUpdatedUtc")
     except Exception as e:
         logging.error(f"Failed downloading: {resource['Title']} error: {e}")
+        metrics.inc("itslearning_dl_downloads_total", result="failed")
+        # Classify by the original error, e.g. ConnectionError instead of the wrapping Exception
+        cause = e
+        while cause.__cause__ is not None:
+            cause = cause.__cause__
+        return {"elementId": resource["ElementId"], "error": f"{type(e).__name__}: {e}", "errorClass": type(cause).__name__,
+                "resource": {key: resource.get(key) for key in PLAN_KEYS}}
+    if "files" in record:
+        logging.debug(f"Resource '{resource['Title']}' has {record['files']} files")
+        files = [dict({key: resource.get(key) for key in PLAN_KEYS}, ElementId=f"{resource['ElementId']}/{index}",
+                      ParentId=resource["ElementId"], FileIndex=index, Resolution=resolution)
+                 for index in range(record["files"])]
+        record = {"path": os.path.join(sanitized_path.lstrip('/'), resource["Title"]), "files": files,
+                  "resource": {key: resource.get(key) for key in PLAN_KEYS}, "replaced": record["replaced"]}
+    elif "skipped" in record:
+        logging.info(f"Skipped resource '{resource['Title']}': {record['skipped']}")
+        metrics.inc("itslearning_dl_downloads_total", result="skipped")
+    elif record.pop("unchanged", False):
+        logging.info(f"Unchanged resource '{resource['Title']}")
+        metrics.inc("itslearning_dl_downloads_total", result="unchanged")
     else:
         logging.info(f"Downloaded resource '{resource['Title']}")
+        metrics.inc("itslearning_dl_downloads_total", result="ok")
+    record.update({"elementId": resource["ElementId"], "title": resource["Title"], "courseId": resource["CourseId"], "lastUpdatedUtc": resource.get("LastUpdatedUtc")})
+    if resolved:
+        record["resolution"] = resolution
+    return record
 
-def start_download_file_resource(resource):
+def start_download_file_resource(course_id, resource, emit):
     try:
-        # Add download resource
-        resources.append({ 'ElementId': resource['ElementId'], 'Title': resource['Title'], 'Path': resource['Path']})
+        # Hand the resource to the download engine
+        emit({ 'ElementId': resource['ElementId'], 'Title': resource['Title'], 'Path': resource['Path'],
+               'CourseId': course_id, 'LastUpdatedUtc': resource.get('LastUpdatedUtc')})
+    except StopRequested:
+        raise
     except Exception as e:
         logging.error(f"Failed adding downloading: {resource['Title']}")
         logging.debug(e)
 
 
-def download_folder_recursive(course_id, folder_resource):
+def query_crawl_node(node):
+    """Fetch all pages of the resources of a course root or folder; None signals an error."""
+    course_id, folder_resource = node
     try:
-        sanitized_path = sanitize_path(folder_resource["Path"])
-        # Use os.path.join to handle spaces in folder names
-        folder_path = os.path.join(output_folder, sanitized_path, folder_resource["Title"])
-        # Use quote to handle special characters in folder names
-        folder_path = quote(folder_path)
-        # Path(folder_path).mkdir(parents=True, exist_ok=True)
-
-        folder = query_folder_resources(course_id, folder_resource["ElementId"])
-        if folder:
-            logging.info(f" -> add sub folder: {folder_resource['Title']}")
-            for resource in tqdm(folder, desc="Files", leave=False):
-                if resource["ElementType"] == "Folder":
-                    # Pass the updated folder_path to the recursive call
-                    download_folder_recursive(course_id, resource)
-                elif resource["ElementType"] == "LearningToolElement":
-                    start_download_file_resource(resource)
+        if folder_resource is None:
+            return list(query_course_resources(course_id))
+        return list(query_folder_resources(course_id, folder_resource["ElementId"]))
     except Exception as e:
-        logging.error(f"An error occurred: {e}")
+        title = folder_resource["Title"] if folder_resource else course_id
+        logging.error(f"An error occurred while crawling '{title}': {e}")
+        return None
+
+def crawl_folder_trees(course_ids, emit, course_done, previous_snapshots=None):
+    """Crawl the folder trees of all courses breadth-first.
+
+    Each level of folders is queried concurrently on the crawl executor, which
+    bounds the in-flight folder requests across all courses. Results are handled
+    in submission order, so resources are emitted in a deterministic order.
+    course_done(course_id, ok, folders, snapshot) is called once a course tree
+    is complete; ok is False when any of its folders failed, so a broken course
+    does not affect the others. A folder whose LastUpdatedUtc is the same as
+    in the previous snapshot of its course is not requested, its listing is
+    taken from the snapshot.
+    """
+    pending = {course_id: 1 for course_id in course_ids}
+    folders = {course_id: [] for course_id in course_ids}
+    snapshots = {course_id: CourseSnapshot() for course_id in course_ids}
+    previous_snapshots = previous_snapshots or {}
+    failed = set()
+    level = [(course_id, None) for course_id in course_ids]
+
+    def fetch(node):
+        course_id, folder_resource = node
+        previous = previous_snapshots.get(course_id)
+        if folder_resource is not None and previous is not None:
+            listing = previous.unchanged_listing(folder_resource)
+            if listing is not None:
+                logging.debug(f"Unchanged folder '{folder_resource['Title']}', not requested")
+                metrics.inc("itslearning_dl_pruned_total")
+                return listing
+        return query_crawl_node(node)
+
+    from tqdm import tqdm
+    with ThreadPoolExecutor(max_workers=crawl_worker_count) as crawl_executor, \
+            tqdm(total=len(level), desc="Folders", leave=False) as progress:
+        while level:
+            next_level = []
+            for (course_id, folder_resource), folder in zip(level, crawl_executor.map(partial(run_as, current_account(), fetch), level)):
+                progress.update()
+                pending[course_id] -= 1
+                if folder is None:
+                    failed.add(course_id)
+                else:
+                    snapshots[course_id].add_listing(ROOT if folder_resource is None else str(folder_resource["ElementId"]), folder)
+                    if folder and folder_resource is not None:
+                        logging.info(f" -> add sub folder: {folder_resource['Title']}")
+                    for resource in folder:
+                        if not get_crawl_filter().resource(resource, sanitize_path(resource["Path"])):
+                            # Excluded folders are not queried at all
+                            logging.debug(f"Filtered out {resource['ElementType']} '{resource['Title']}'")
+                            metrics.inc("itslearning_dl_filtered_total", kind=resource["ElementType"])
+                            continue
+                        if resource["ElementType"] == "Folder":
+                            next_level.append((course_id, resource))
+                            folders[course_id].append(resource)
+                            pending[course_id] += 1
+                        elif resource["ElementType"] == "LearningToolElement":
+                            start_download_file_resource(course_id, resource, emit)
+                if pending[course_id] == 0:
+                    course_done(course_id, course_id not in failed, folders.pop(course_id), snapshots.pop(course_id))
+            progress.total += len(next_level)
+            progress.refresh()
+            level = next_level
+
+def handle_download_result(store, result):
+    """Store a download result; returns False for a failed download."""
+    resolution = result.pop("resolution", None)
+    worker_metrics = result.pop("metrics", None)
+    if worker_metrics is not None:
+        metrics.merge(worker_metrics)
+    with store.transaction():
+        if result.pop("replaced", False):
+            # A single file replaced the folder of the element, forget the files that were in it
+            for file_record in store.get_elements(result["elementId"]):
+                store.delete_element(file_record["elementId"])
+        if "error" in result:
+            store.record_download(result["elementId"], False, result["error"])
+            store.record_failure(result["resource"], result["errorClass"], result["error"])
+            store.delete_resolution(result["elementId"])
+            return False
+        if resolution is not None:
+            store.set_resolution(result["elementId"], resolution)
+        if "skipped" in result:
+            # Not recorded, so the element is checked again on the next crawl of its course
+            store.clear_failure(result["elementId"])
+            return True
+        store.set_element(result)
+        store.record_download(result["elementId"], True)
+        store.clear_failure(result["elementId"])
+    return True
+
+def file_resources(store, result):
+    """Get the file tasks of an expanded multi-file element with their previous records."""
+    if result.pop("replaced", False):
+        # The single file of the element was removed for its folder
+        store.delete_element(result["elementId"])
+    for resource in result["files"]:
+        resource["Previous"] = store.get_element(resource["ElementId"])
+    return result["files"]
+
+def name_element_files(file_results):
+    """Move the new files of a multi-file element from their fallback name to the name of their Content-Disposition.
+
+    Unchanged files keep their name; the others are named in the order of
+    the element, and " (n)" with their number n is added to a name another
+    file of the element has already, so no file overwrites another.
+    """
+    output = current_account().output_folder
+    stored = [file_result for file_result in file_results if "error" not in file_result and "skipped" not in file_result]
+    taken = {os.path.basename(file_result["path"]) for file_result in stored if "name" not in file_result}
+    # The fallback names the other new files are still kept under
+    fallbacks = {os.path.basename(file_result["path"]) for file_result in stored if "name" in file_result}
+    for file_result in stored:
+        if "name" not in file_result:
+            continue
+        fallback = os.path.basename(file_result["path"])
+        name = file_result.pop("name") or fallback
+        number = int(str(file_result["elementId"]).rsplit("/", 1)[1]) + 1
+        stem, extension = os.path.splitext(name)
+        suffix = 0
+        while name in taken or (name in fallbacks and name != fallback):
+            suffix += 1
+            name = f"{stem} ({number}){extension}" if suffix == 1 else f"{stem} ({number}-{suffix}){extension}"
+        taken.add(name)
+        if name != fallback:
+            folder = os.path.dirname(file_result["path"])
+            os.replace(os.path.join(output, file_result["path"]), os.path.join(output, folder, name))
+            file_result["path"] = os.path.join(folder, name)
+
+def merge_file_results(store, result, file_results):
+    """Store the records of the files of a multi-file element; returns the result of the element.
+
+    The element only counts as downloaded when all of its files are, so a
+    failed file queues the whole element for a retry; its downloaded files
+    are unchanged then and not transferred again.
+    """
+    failures = []
+    content_length = 0
+    worker_metrics = result.pop("metrics", None)
+    if worker_metrics is not None:
+        metrics.merge(worker_metrics)
+    name_element_files(file_results)
+    with store.transaction():
+        for file_result in file_results:
+            file_result.pop("resolution", None)
+            worker_metrics = file_result.pop("metrics", None)
+            if worker_metrics is not None:
+                metrics.merge(worker_metrics)
+            if "error" in file_result:
+                failures.append(file_result)
+                continue
+            if "skipped" in file_result:
+                continue
+            store.set_element(file_result)
+            content_length += int(file_result.get("contentLength") or 0)
+    resource = result.pop("resource")
+    del result["files"]
+    if failures:
+        return {"elementId": result["elementId"], "error": f"{len(failures)} of {len(file_results)} files failed, first: {failures[0]['error']}",
+                "errorClass": failures[0]["errorClass"], "resource": resource}
+    result["contentLength"] = str(content_length)
+    return result
+
+def is_element_unchanged(previous, resource):
+    """Check whether an element is unchanged since its last download."""
+    return bool(previous and resource.get("LastUpdatedUtc")
+                and previous.get("lastUpdatedUtc") == resource["LastUpdatedUtc"]
+                and os.path.exists(os.path.join(current_account().output_folder, previous["path"])))
+
+def relocate_element(store, previous, resource):
+    """Move the file (or files) of an element that was renamed or moved in its course, so it isn't downloaded again.
+
+    Returns the updated record; the previous one if nothing was moved.
+    """
+    path = os.path.join(sanitize_path(resource["Path"]).lstrip('/'), resource["Title"])
+    if not previous.get("path") or previous["path"] == path:
+        return previous
+    output = current_account().output_folder
+    old_path = os.path.join(output, previous["path"])
+    new_path = os.path.join(output, path)
+    if not os.path.exists(old_path) or os.path.exists(new_path):
+        return previous
+    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+    os.replace(old_path, new_path)
+    logging.info(f"Moved '{previous['path']}' to '{path}'")
+    metrics.inc("itslearning_dl_relocated_total")
+    record = dict(previous, path=path, title=resource["Title"])
+    with store.transaction():
+        store.set_element(record)
+        # The files of a multi-file element moved with its folder
+        for file_record in store.get_elements(previous["elementId"]):
+            store.set_element(dict(file_record, path=path + file_record["path"][len(previous["path"]):]))
+    try:
+        # Drop the folders the element leaves empty
+        os.removedirs(os.path.dirname(old_path))
+    except OSError:
+        pass
+    return record
+
+def previous_files(store, previous):
+    """Get the paths of the files of an element that was downloaded as a multi-file element, to remove them if it has a single file now."""
+    if not previous or not os.path.isdir(os.path.join(current_account().output_folder, previous["path"])):
+        return []
+    return [record["path"] for record in store.get_elements(previous["elementId"])]
+
+def changed_resource_emitter(store, emit, skip=()):
+    """Wrap emit to skip unchanged elements (and the IDs in skip) and attach the previous record and cached resolution.
+
+    Renamed and moved elements are moved in the output folder first, so only
+    their changes are downloaded. Emitted elements stay queued as pending
+    until their result is stored.
+    """
+    def emit_changed(resource):
+        if str(resource["ElementId"]) in skip:
+            return
+        previous = store.get_element(resource["ElementId"])
+        if previous is not None:
+            previous = relocate_element(store, previous, resource)
+        if is_element_unchanged(previous, resource):
+            logging.debug(f"Skip unchanged resource '{resource['Title']}'")
+            return
+        # Its course may be stored as crawled before the download is done
+        store.record_pending({key: resource.get(key) for key in PLAN_KEYS})
+        resource["Previous"] = previous
+        resource["PreviousFiles"] = previous_files(store, previous)
+        if resolution_ttl > 0:
+            resolution = store.get_resolution(resource["ElementId"], resolution_ttl)
+            # A resolution belongs to a version of the element, e.g. its number of files may have changed since
+            if resolution and resolution.get("lastUpdatedUtc") == resource.get("LastUpdatedUtc"):
+                resource["Resolution"] = resolution
+        emit(resource)
+    return emit_changed
+
+def course_list():
+    """Yield the enrolled courses that pass the filter; raises if the course list can't be fetched completely."""
+    import requests
+    try:
+        for course in query_course_list():
+            if get_crawl_filter().course(course):
+                yield course
+            else:
+                logging.debug(f"Filtered out course '{course['Title']}'")
+                metrics.inc("itslearning_dl_filtered_total", kind="Course")
+    except requests.RequestException as e:
+        logger.error(f"Request failed: {e}")
+        raise Exception("Fetching the course list failed") from e
+    except KeyError as ke:
+        logger.error(f"KeyError: {ke}. Check the JSON structure for 'EntityArray'")
+        raise Exception("Fetching the course list failed") from ke
+
+def apply_course_diff(store, title, diff):
+    """Log the changes of a course tree since its last crawl and forget the queued failures of removed elements.
+
+    Renamed and moved elements were moved in the output folder when they
+    were emitted (see relocate_element); removed elements keep their files.
+    """
+    summary = ", ".join(f"{len(element_ids)} {change}" for change, element_ids in diff.items() if element_ids)
+    if summary:
+        logging.info(f"-> {title}: {summary}")
+    for change, element_ids in diff.items():
+        if element_ids:
+            metrics.inc("itslearning_dl_tree_changes_total", len(element_ids), change=change)
+    for element_id in diff["removed"]:
+        previous = store.get_element(element_id)
+        logging.debug(f"Removed from the course: {previous['path'] if previous else element_id}")
+        store.clear_failure(element_id)
+        store.delete_resolution(element_id)
+
+def crawl_courses(store, emit):
+    """Crawl all updated courses and hand every new or changed file resource to emit.
+
+    The tree of every crawled course is kept as a snapshot; the next crawl
+    compares against it and skips the folders that didn't change.
+    """
+    updated = {}
+    previous_snapshots = {}
+
+    def course_done(course_id, ok, folders, snapshot):
+        if not ok:
+            logging.warning(f"Course {course_id} was not crawled completely and will be crawled again next time.")
+            return
+        last_updated, title = updated[course_id]
+        with store.transaction():
+            previous = previous_snapshots.get(course_id)
+            if previous is not None:
+                apply_course_diff(store, title, diff_snapshots(previous, snapshot))
+            store.set_snapshot(course_id, snapshot.to_json())
+            store.set_course(course_id, last_updated, title, folders)
+
+    # Retry the failures of earlier runs first, their courses may not have changed since
+    retried = collect_failures(store, emit, failure_retry_limit)
+    emit_changed = changed_resource_emitter(store, emit, retried)
+
+    from tqdm.contrib.logging import logging_redirect_tqdm
+    with logging_redirect_tqdm():
+        # Loop through all enrolled courses as their pages arrive
+        for course in course_list():
+            courseId = str(course["CourseId"])
 
-def worker(resource, access_token):
-    download_file_resource(resource, access_token)
+            # If the course was not updated since the last request, skip downloading
+            last_updated_date = datetime.datetime.strptime(
+                course["LastUpdatedUtc"], "%Y-%m-%dT%H:%M:%SZ")
+            if store.get_course_updated(courseId) >= last_updated_date.timestamp():
+                continue
+            updated[courseId] = (last_updated_date.timestamp(), course["Title"])
+            previous = CourseSnapshot.from_json(store.get_snapshot(courseId))
+            if previous is not None:
+                previous_snapshots[courseId] = previous
+
+            logging.info(f"-> add course {course['Title']}")
+
+        # Download all resources (since we don't have any indication of which resource has changed)
+        crawl_folder_trees(list(updated), emit_changed, course_done, previous_snapshots if folder_pruning else None)
+
+def collect_failures(store, emit, max_attempts=None):
+    """Hand the elements that failed before to emit, without crawling; returns their IDs."""
+    retried = set()
+    failures = store.get_failures(max_attempts)
+    if failures:
+        logging.info(f"Retry {len(failures)} failed elements")
+    for failure in failures:
+        resource = dict(failure["resource"])
+        logging.debug(f"Retry '{resource['Title']}' (attempt {failure['attempts'] + 1}, last error {failure['errorClass']})")
+        resource["Previous"] = store.get_element(resource["ElementId"])
+        resource["PreviousFiles"] = previous_files(store, resource["Previous"])
+        retried.add(str(resource["ElementId"]))
+        emit(resource)
+    return retried
+
+def collect_plan(store, emit):
+    """Hand the new or changed resources of this shard of the plan to emit."""
+    emit_changed = changed_resource_emitter(store, emit)
+    for resource in read_plan(plan_file, shard):
+        emit_changed(resource)
+
+def write_crawl_plan(path):
+    """Crawl all courses, ignoring the state, and write their file resources to a JSONL plan.
+
+    Returns the number of resources in the plan.
+    """
+    def course_done(course_id, ok, folders, snapshot):
+        if not ok:
+            logging.warning(f"Course {course_id} was not crawled completely, its plan is incomplete.")
+
+    from tqdm.contrib.logging import logging_redirect_tqdm
+    with logging_redirect_tqdm(), PlanWriter(path) as writer:
+        crawl_folder_trees([str(course["CourseId"]) for course in course_list()], writer.write, course_done)
+    return writer.count
+
+def verify_element(record):
+    """Check the file of an element against its record without network access.
+
+    Returns the status ('ok', 'missing' or 'corrupted') and the stat of the
+    file if it was hashed and found intact, so its record can be updated.
+    """
+    full_path = os.path.join(current_account().output_folder, record["path"])
+    try:
+        stat = os.stat(full_path)
+    except FileNotFoundError:
+        return "missing", None
+    if os.path.isdir(full_path):
+        # The folder of a multi-file element, its files are checked themselves
+        return "ok", None
+    if record.get("size") is not None and stat.st_size != record["size"]:
+        return "corrupted", None
+    if not record.get("sha256") or (verify_mode == "quick" and record.get("mtime") == stat.st_mtime):
+        return "ok", None
+    file_hash = hashlib.sha256()
+    with open(full_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            file_hash.update(chunk)
+    if file_hash.hexdigest() != record["sha256"]:
+        return "corrupted", None
+    return "ok", stat
+
+def verify_mirror(store):
+    """Check the output folder against the state and queue the elements with broken files.
+
+    The files are checked on worker_count threads by size and mtime, and by
+    hash if their mtime changed (or always in the full mode). Elements with a
+    missing or corrupted file are queued as failures, so the next run (or
+    --retry-failed) downloads only them. Returns the number of checked elements
+    and the number of queued elements.
+    """
+    records = [record for record in store.get_elements() if record.get("path")]
+    queued = set()
+    from tqdm import tqdm
+    with ThreadPoolExecutor(max_workers=worker_count) as verify_executor, store.transaction():
+        statuses = tqdm(verify_executor.map(partial(run_as, current_account(), verify_element), records), total=len(records), desc="Verify", leave=False)
+        for record, (status, stat) in zip(records, statuses):
+            if status == "ok":
+                if stat is not None:
+                    store.set_element(dict(record, size=stat.st_size, mtime=stat.st_mtime))
+                continue
+            logging.warning(f"{status.capitalize()}: {record['path']}")
+            if status == "corrupted":
+                forget_corrupted_file(store, record)
+            # A file of a multi-file element is downloaded again through its element
+            element_id = str(record["elementId"]).split("/")[0]
+            element = store.get_element(element_id)
+            if element is None or element_id in queued:
+                continue
+            resource = {"ElementId": element_id, "Title": element["title"], "Path": os.path.dirname(element["path"]),
+                        "CourseId": element["courseId"], "LastUpdatedUtc": element.get("lastUpdatedUtc")}
+            store.record_failure(resource, "CorruptedFile" if status == "corrupted" else "MissingFile", f"{status}: {record['path']}")
+            queued.add(element_id)
+    return len(records), len(queued)
+
+def forget_corrupted_file(store, record):
+    """Make sure a corrupted file is downloaded again instead of being found unchanged."""
+    store.set_element(dict(record, etag=None, lastModified=None))
+    if record.get("sha256") and get_dedup_store() is not None:
+        # A hardlinked file is the blob itself, which must not be placed again
+        blob_path = dedup_store.blob_path(record["sha256"])
+        full_path = os.path.join(current_account().output_folder, record["path"])
+        if os.path.exists(blob_path) and os.path.samefile(blob_path, full_path):
+            os.remove(blob_path)
+
+def init_worker(settings, parent_token):
+    """Apply the settings and token of the parent and drop the sessions inherited from it, so no socket is shared across processes."""
+    global session_pool, scheduler, html_extractor, default_account, accounts, dedup_store, page_executor
+    globals().update(settings)
+    dedup_store = None
+    default_account = make_default_account()
+    default_account.token = parent_token
+    default_account.access_token = parent_token["access_token"]
+    accounts = [default_account]
+    session_pool = None
+    scheduler = None
+    page_executor = None
+    html_extractor = None
+
+def worker(resource):
+    # Hand the metrics of this download back to the parent process
+    metrics.reset()
+    result = download_file_resource(resource)
+    result["metrics"] = metrics.snapshot()
+    return result
+
+def download_resources_pool(store, collect=crawl_courses):
+    """Crawl (or read the plan), then download the collected resources with a process pool.
+
+    Returns the number of resources and the number of failures.
+    """
+    global pool
+    logger.info(f"Collect all elements in courses...")
+    crawl_start = time.perf_counter()
+    collect(store, resources.append)
+    metrics.set("itslearning_dl_run_seconds", time.perf_counter() - crawl_start, phase="crawl")
+    if not resources:
+        return 0, 0
+    logger.info(f"Download {len(resources)} elements with {min(worker_count, len(resources))} worker (pool)...")
+    download_start = time.perf_counter()
+    # Start the largest files first, so none of them is left for the end
+    ordered = SizeQueue()
+    for resource in resources:
+        ordered.push(resource, remembered_size(resource))
+    from multiprocessing import Pool
+    pool = Pool(worker_count, initializer=init_worker, initargs=(get_settings(), current_account().token))
+    results = deque((pool.apply_async(worker, (ordered.pop(),)), None) for _ in range(len(resources)))
+    failed = 0
+    while results:
+        pending, expanded = results.popleft()
+        if expanded is None:
+            result = pending.get()
+            if "files" in result:
+                # The files of a multi-file element go to the pool as well, the element is stored once they are done
+                results.append(([pool.apply_async(worker, (file_resource,)) for file_resource in file_resources(store, result)], result))
+                continue
+        else:
+            result = merge_file_results(store, expanded, [file_result.get() for file_result in pending])
+        if not handle_download_result(store, result):
+            failed += 1
+    pool.close()
+    pool.join()
+    metrics.set("itslearning_dl_run_seconds", time.perf_counter() - download_start, phase="download")
+    return len(resources), failed
+
+async def download_resources_async(store, collect=crawl_courses, account=None):
+    """Crawl (or read the plan) and download concurrently as coroutines.
+
+    The crawl runs in a thread and feeds a bounded queue, so downloads start
+    while the crawl is still running and memory stays flat. The queue hands
+    out the largest remembered sizes first (see SizeQueue). requests is
+    blocking, so every element's SSO -> iframe -> file chain is handed to a
+    bounded thread executor while all sessions share one connection pool.
+    The threads work for the given account (default: the current one).
+    Returns the number of resources and the number of failures.
+    """
+    import asyncio
+    global executor
+    loop = asyncio.get_running_loop()
+    account = account or current_account()
+    queue = SizeQueue()
+    # A few queued elements per worker give the queue room to order them
+    space = asyncio.Semaphore(worker_count * 4)
+    queued = asyncio.Semaphore(0)
+    total = 0
+    failed = 0
+    # The download phase runs from the first started to the last finished download
+    download_start = None
+
+    def emit(resource):
+        nonlocal total
+        if stop_requested.is_set():
+            raise StopRequested()
+        total += 1
+        # Blocks the crawl while the queue is full
+        asyncio.run_coroutine_threadsafe(put(resource), loop).result()
+
+    async def put(resource):
+        await space.acquire()
+        if stop_requested.is_set():
+            # Pass the room on to the next waiting crawl thread, the element stays queued as pending in the state
+            space.release()
+            return
+        queue.push(resource, remembered_size(resource))
+        queued.release()
+
+    async def consume():
+        nonlocal failed, download_start
+        while True:
+            await queued.acquire()
+            if not queue:
+                # Only woken without an element once the crawl is done
+                break
+            if stop_requested.is_set():
+                # The queued elements are pending in the state and downloaded on the next run;
+                # the room lets a crawl thread waiting in emit see the stop
+                space.release()
+                break
+            resource = queue.pop()
+            space.release()
+            download_start = download_start or time.perf_counter()
+            result = await loop.run_in_executor(executor, run_as, account, download_file_resource, resource)
+            if "files" in result:
+                # The files of a multi-file element are downloaded concurrently on the same executor
+                file_results = await asyncio.gather(
+                    *(loop.run_in_executor(executor, run_as, account, download_file_resource, file_resource)
+                      for file_resource in file_resources(store, result)))
+                result = run_as(account, merge_file_results, store, result, file_results)
+            metrics.set("itslearning_dl_run_seconds", time.perf_counter() - download_start, phase="download")
+            if not handle_download_result(store, result):
+                failed += 1
+
+    async def produce():
+        crawl_start = time.perf_counter()
+        try:
+            await asyncio.to_thread(run_as, account, collect, store, emit)
+        except StopRequested:
+            # Courses that were not crawled completely are crawled again next time
+            logger.info("Stop crawling, finish the running downloads...")
+        finally:
+            metrics.set("itslearning_dl_run_seconds", time.perf_counter() - crawl_start, phase="crawl")
+            for _ in range(worker_count):
+                queued.release()
+
+    logger.info(f"Collect and download all elements in courses with {worker_count} worker (async)...")
+    # The watch mode keeps one executor (and so the sessions of its threads) for all polls
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=worker_count)
+    try:
+        await asyncio.gather(produce(), *(consume() for _ in range(worker_count)))
+    finally:
+        if own_executor:
+            executor.shutdown(wait=True)
+            executor = None
+    return total, failed
+
+def request_stop(sig, frame):
+    """Stop the crawl and downloads of the async engine (and the watch mode after the running poll), leaving the state consistent.
+
+    A second signal ends the process right away, e.g. if a transfer stalls.
+    """
+    logging.warning(f"Received {signal.Signals(sig).name}, stopping after the running downloads (again to exit immediately)...")
+    stop_requested.set()
+    for other in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(other, signal.SIG_DFL)
+
+def stop_on_signals():
+    """Handle SIGINT and SIGTERM with request_stop.
+
+    Exiting in the event loop would leave the crawl thread waiting in emit for
+    room in the queue, and asyncio.run waiting for that thread forever; with
+    stop_requested, emit raises StopRequested, the queued elements stay
+    pending for the next run and only the running downloads finish.
+    """
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, request_stop)
+
+def watch(store):
+    """Poll the course list and download the changes until SIGINT or SIGTERM.
+
+    Only courses with a newer LastUpdatedUtc are crawled again. The download
+    threads, their keep-alive sessions and the access token are kept between
+    polls; the token is refreshed when it expires. Always uses the async engine.
+    Returns the number of resources and the number of failures of all polls.
+    """
+    global executor
+    import asyncio
+    stop_on_signals()
+    executor = ThreadPoolExecutor(max_workers=worker_count)
+    polls = 0
+    all_total = 0
+    all_failed = 0
+    try:
+        while not stop_requested.is_set():
+            polls += 1
+            poll_start = time.perf_counter()
+            try:
+                if not is_token_valid(current_account().token):
+                    get_access_token(current_account())
+                total, failed = asyncio.run(download_resources_async(store))
+                store.flush()
+                all_total += total
+                all_failed += failed
+                if total == 0:
+                    logger.info("No new elements found!")
+                elif failed:
+                    logger.warning(f"{failed} of {total} downloads failed!")
+                else:
+                    logger.info(f"Downloaded {total} new or changed elements")
+            except Exception as e:
+                logger.error(f"Poll {polls} failed: {e}")
+            metrics.inc("itslearning_dl_polls_total")
+            metrics.set("itslearning_dl_run_seconds", time.perf_counter() - poll_start, phase="poll")
+            if metrics_file:
+                metrics.export(metrics_file)
+            if stop_requested.is_set():
+                break
+            delay = watch_interval * random.uniform(1 - watch_jitter, 1 + watch_jitter)
+            logger.info(f"Next poll in {format_time(delay)}")
+            stop_requested.wait(delay)
+    finally:
+        executor.shutdown(wait=True)
+        executor = None
+    logger.info(f"Stopped after {polls} polls")
+    return all_total, all_failed
 
 def format_time(seconds):
     """Format time in seconds to a string in seconds or minutes."""
     return "{:.2f} min".format(seconds / 60) if seconds > 60 else "{:.2f}s".format(seconds)
 
-def log_statistics(logger, total_elements, download_time, total_time):
-    """Log download and total time statistics."""
+def log_statistics(logger, total_elements, crawl_time, download_time, total_time):
+    """Log crawl, download and total time statistics."""
     logger.info(f"Total downloads processed: {total_elements}")
+    logger.info(f"Crawl time taken: {format_time(crawl_time)}")
     if total_elements > 0:
         logger.info(f"Download time taken: {format_time(download_time)}")
     logger.info(f"Total time taken: {format_time(total_time)}")
 
-def main():
-    global access_token, pool
+async def sync_accounts(selected, collect):
+    """Sync several accounts at once on one download executor.
+
+    The executor hands its threads to the queued downloads of all accounts
+    in turn, and the scheduler limits every instance on its own, so one large
+    account doesn't hold the others back. Returns the number of resources and
+    the number of failures of all accounts.
+    """
+    import asyncio
+    global executor
+    executor = ThreadPoolExecutor(max_workers=worker_count)
+    try:
+        results = await asyncio.gather(*(sync_account(account, collect) for account in selected))
+    finally:
+        executor.shutdown(wait=True)
+        executor = None
+    return sum(total for total, _ in results), sum(failed for _, failed in results)
+
+def open_account_store(account):
+    """Open the state store of an account; like the state of a single account it is only kept in memory with --noinstall."""
+    from state_store import open_state_store
+    if install_sys:
+        Path(account.state_dir).mkdir(parents=True, exist_ok=True)
+    return open_state_store(state_backend, account.state_dir, install_sys)
+
+async def sync_account(account, collect):
+    """Log in and sync one account into its own output folder and state; a failed account doesn't stop the others."""
+    import asyncio
+    store = open_account_store(account)
+    try:
+        if refetch:
+            store.clear()
+        with metrics.timer("login"):
+            await asyncio.to_thread(run_as, account, get_access_token, account)
+        if not account.access_token:
+            logger.error(f"[{account.name}] Login failed for {account.username}")
+            return 0, 1
+        logger.info(f"[{account.name}] Login: {account.username} ({account.instance}) -> {account.output_folder}")
+        total, failed = await download_resources_async(store, collect, account)
+        if failed:
+            logger.warning(f"[{account.name}] {failed} of {total} downloads failed!")
+        else:
+            logger.info(f"[{account.name}] {total} new or changed elements")
+        queued = len(store.get_failures())
+        if queued:
+            logger.warning(f"[{account.name}] {queued} failed elements are queued and retried on the next run")
+        return total, failed
+    except Exception as e:
+        logger.error(f"[{account.name}] Sync failed: {e}")
+        return 0, 1
+    finally:
+        store.close()
+
+def verify_account(store):
+    """Verify the mirror of the current account and log the result."""
+    logging.info(f"Verify the files in {current_account().output_folder} ({verify_mode})")
+    verify_start = time.perf_counter()
+    try:
+        checked, queued = verify_mirror(store)
+    finally:
+        store.close()
+    logging.info(f"Verified the files of {checked} elements in {format_time(time.perf_counter() - verify_start)}")
+    if queued:
+        logger.warning(f"{queued} elements with missing or corrupted files are queued and downloaded on the next run (--retry-failed to download only them)")
+    else:
+        logger.info("All files are intact")
+
+def log_run_summary(total_elements, main_start_time):
+    """Log the statistics of the run and write the metrics."""
+    total_time = time.time() - main_start_time
+    metrics.set("itslearning_dl_run_seconds", total_time, phase="total")
+
+    log_statistics(logger, total_elements, metrics.get("itslearning_dl_run_seconds", 0, phase="crawl"),
+                   metrics.get("itslearning_dl_run_seconds", 0, phase="download"), total_time)
+    from session_pool import connection_stats
+    scope = " (crawl only, the download processes keep their own)" if engine == "pool" and len(accounts) == 1 else ""
+    logger.info(f"Connections{scope}: {connection_stats.connections} new, {connection_stats.reused()} reused for {connection_stats.requests} requests")
+    if scheduler is not None and (scheduler.retries or scheduler.failures):
+        logger.info(f"Requests{scope}: {scheduler.retries} retries, {scheduler.failures} failed after all retries")
+    if metrics_file:
+        metrics.export(metrics_file)
+        logger.info(f"Metrics written to {metrics_file}")
+
+def main(argv=None):
+    global token_cache_path, default_account, accounts
 
     main_start_time = time.time()
+    start_time_string = datetime.datetime.now().strftime("%d-%m-%Y %H_%M_%S")
+
+    # Read the config once, it provides the defaults of the arguments
+    conf = ConfManager(conf_path)
+    configure(conf, parse_args(conf, argv))
+
     sys_path_exist = Path(sys_path).exists()
     logging_path_exist = Path(logging_path).exists()
 
@@ -333,7 +1863,7 @@ def main():
     while logger.hasHandlers():
         logger.removeHandler(logger.handlers[0])
 
-    logger.setLevel(logging.getLevelName(args.loglvl.upper()))
+    logger.setLevel(logging.getLevelName(log_level.upper()))
 
     if not sys_path_exist and install_sys:
         Path(sys_path).mkdir(parents=True, exist_ok=True)
@@ -376,106 +1906,145 @@ def main():
         os._exit(1)
     
     if open_state:
-        conf.open_conf(state_path)
-        logging.critical("Opening state file resulted in a process exit!")
-        os._exit(1)
+        open_state_file(conf)
+
+    if conf.get_param("ACCOUNTS"):
+        main_accounts(conf, main_start_time)
+        return
+
+    # Open the state store (and migrate an existing state.json)
+    from state_store import open_state_store
+    store = open_state_store(state_backend, sys_path, install_sys)
+
+    if verify_mode:
+        # Only local I/O, no login
+        default_account = make_default_account()
+        verify_account(store)
+        return
 
     if not username or not password or not itslearning_instance:
         logging.critical("Username, password or instance url missing! (use --config to open the config)")
         os._exit(1)
 
+    # Fail early if the chosen HTML extractor is not installed
+    get_html_extractor()
+
     if(refetch):
-        remove_state_file()
+        logging.info("Clear the state to download all elements")
+        store.clear()
 
     logging.info(f"Output path: {output_folder}")
 
+    # Keep the token between runs, readable by the user only
+    if use_token_cache and (sys_path_exist or install_sys):
+        token_cache_path = str(sys_path / 'token.json')
+
+    default_account = make_default_account()
+    accounts = [default_account]
+
     # Login
-    access_token = get_access_token(username, password)
-    if(not access_token):
+    with metrics.timer("login"):
+        get_access_token(default_account)
+    if(not default_account.access_token):
         logging.critical("Login failed. Please check your username, password, or use '--loglvl debug' for more details.")
         os._exit(1)
     
     logging.info(f"-> Login: {username}")
 
-    # Make sure the state file exists
-    if not os.path.exists(state_path) and install_sys:
-        f = open(state_path, "w")
-        f.write("{}")
-        f.close()
-
-    # Load the current state
-    if install_sys:
-        f = open(state_path, "r")
-        try:
-            state = json.loads(f.read())
-        except:
-            traceback.print_exc()
-            logging.warning("State file corrupt! The tool may not behave as intended.")
-            state = {}
-        f.close()
-    else:
-        state = {}
-        
-    if not 'course' in state:
-        state["course"] = {}
-
-    logger.info(f"Collect all elements in courses...")
-
-    # Loop through all enrolled courses
-    with logging_redirect_tqdm():
-        for course in tqdm(query_course_list(), desc="Courses"):
-            courseId = str(course["CourseId"])
-            if not courseId in state["course"]:
-                state["course"][courseId] = {"lastUpdated": 0}
-
-            # If the course was not updated since the last request, skip downloading
-            last_updated_date = datetime.datetime.strptime(
-                course["LastUpdatedUtc"], "%Y-%m-%dT%H:%M:%SZ")
-            if state["course"][courseId]["lastUpdated"] >= last_updated_date.timestamp():
-                continue
-            state["course"][courseId]["lastUpdated"] = last_updated_date.timestamp()
-
-            logging.info(f"-> add course {course['Title']}")
-
-            # Download all resources (since we don't have any indication of which resource has changed)
-            for resource in tqdm(query_course_resources(courseId), desc="Resources", leave=False):
-                if resource["ElementType"] == "Folder":
-                    download_folder_recursive(courseId, resource)
-
-                if resource["ElementType"] != "LearningToolElement":
-                    continue
-
-                start_download_file_resource(resource)
-
-            # Persist the state
-            if install_sys:
-                f = open(state_path, "w")
-                f.write(json.dumps(state))
-
-    total_elements = len(resources)
+    total_elements = 0
     try:
-        if total_elements > 0:
-            logger.info(f"Download {total_elements} elements with {min(worker_count, total_elements)} worker...")
-            pool = Pool(worker_count)
-            for resource in resources:
-                pool.apply_async(worker, (resource, access_token))
-            pool.close()
-            pool.join()
+        import asyncio
+        if retry_failed:
+            collect = collect_failures
+        elif plan_file:
+            collect = collect_plan
+        else:
+            collect = crawl_courses
+        if plan_only:
+            total_elements, failed = write_crawl_plan(plan_only), 0
+            logging.info(f"Wrote {total_elements} resources to the plan {plan_only}")
+        elif watch_mode:
+            logging.info(f"Watch the courses every {format_time(watch_interval)} (SIGINT or SIGTERM to stop)")
+            total_elements, failed = watch(store)
+        elif engine == "pool":
+            total_elements, failed = download_resources_pool(store, collect)
         else:
+            stop_on_signals()
+            total_elements, failed = asyncio.run(download_resources_async(store, collect))
+        if total_elements == 0:
             logger.info("No new elements found!")
-    except InterruptedError or KeyboardInterrupt:
+        elif failed:
+            logger.warning(f"{failed} of {total_elements} downloads failed!")
+    except (InterruptedError, KeyboardInterrupt):
         logging.critical("The process was interrupted. The current state might be corrupted or inaccurate.")
         if pool is not None:
             pool.terminate()
         sys.exit(0)
+    finally:
+        queued = len(store.get_failures())
+        store.close()
 
-    end_time = time.time()
-    download_time = end_time - main_start_time
-    total_time = end_time - main_start_time
+    if queued:
+        logger.warning(f"{queued} failed elements are queued and retried on the next run (--retry-failed to retry only them)")
 
-    log_statistics(logger, total_elements, download_time, total_time)
+    log_run_summary(total_elements, main_start_time)
+
+def open_state_file(conf):
+    """Open the state file with the default application and exit; with ACCOUNTS the one of the account chosen with --account."""
+    from state_store import open_state_store
+    if conf.get_param("ACCOUNTS"):
+        try:
+            selected = get_accounts(conf)
+        except Exception as e:
+            logging.critical(f"{e} (use --config to open the config)")
+            os._exit(1)
+        if len(selected) != 1:
+            logging.critical("The config has ACCOUNTS, choose the one whose state file to open with --account NAME")
+            os._exit(1)
+        store = open_account_store(selected[0])
+        path = store.path or str(Path(selected[0].state_dir) / 'state.json')
+    else:
+        store = open_state_store(state_backend, sys_path, install_sys)
+        path = store.path or state_path
+    conf.open_conf(path)
+    logging.critical("Opening state file resulted in a process exit!")
+    os._exit(1)
+
+def main_accounts(conf, main_start_time):
+    """Sync (or verify) the ACCOUNTS of the config, each with its own output folder, state and token."""
+    global accounts
+    try:
+        accounts = get_accounts(conf)
+    except Exception as e:
+        logging.critical(f"{e} (use --config to open the config)")
+        os._exit(1)
+    if verify_mode:
+        for account in accounts:
+            logging.info(f"[{account.name}]")
+            run_as(account, verify_account, open_account_store(account))
+        return
+    incomplete = [account.name for account in accounts if not account.username or not account.password or not account.instance]
+    if incomplete:
+        logging.critical(f"Username, password or instance url missing for the accounts: {', '.join(incomplete)} (use --config to open the config)")
+        os._exit(1)
+    get_html_extractor()
+    if engine == "pool":
+        logging.info("Several accounts are synced with the async engine")
+    import asyncio
+    logging.info(f"Sync {len(accounts)} accounts with {worker_count} shared worker")
+    stop_on_signals()
+    try:
+        total_elements, failed = asyncio.run(sync_accounts(accounts, collect_failures if retry_failed else crawl_courses))
+    except (InterruptedError, KeyboardInterrupt):
+        logging.critical("The process was interrupted. The current state might be corrupted or inaccurate.")
+        sys.exit(0)
+    if total_elements == 0 and not failed:
+        logger.info("No new elements found!")
+    elif failed:
+        logger.warning(f"{failed} of {total_elements} downloads failed!")
+    log_run_summary(total_elements, main_start_time)
 
 
 if __name__ == "__main__":
     signal.signal(signal.SIGINT, signal_handler)
-    main()
\ No newline at end of file
+    main()
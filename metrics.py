@@ -0,0 +1,181 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the latency histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float("inf"))
+
+HELP = {
+    "itslearning_dl_phase_seconds": "Duration of hot-path operations by phase",
+    "itslearning_dl_request_seconds": "Latency of HTTP requests by host",
+    "itslearning_dl_bytes_total": "Downloaded file bytes by host",
+    "itslearning_dl_requests_total": "HTTP requests by host and status",
+    "itslearning_dl_retries_total": "Retried HTTP requests by host",
+    "itslearning_dl_request_failures_total": "HTTP requests that failed after all retries by host",
+    "itslearning_dl_downloads_total": "Downloaded elements by result",
+    "itslearning_dl_dedup_total": "Files found in the blob store, skipped before or stored once after the transfer",
+    "itslearning_dl_dedup_bytes_total": "Bytes not stored again or not transferred thanks to the blob store",
+    "itslearning_dl_filtered_total": "Courses, folders and elements skipped by the include and exclude rules by kind",
+    "itslearning_dl_segmented_total": "Files downloaded in parallel ranged segments",
+    "itslearning_dl_pruned_total": "Unchanged folders taken from the snapshot of their course instead of requested",
+    "itslearning_dl_tree_changes_total": "Elements added, removed, renamed or moved since the last crawl of their course by change",
+    "itslearning_dl_relocated_total": "Files of renamed or moved elements moved in the output folder instead of downloaded again",
+    "itslearning_dl_run_seconds": "Wall time of the last run (or poll in the watch mode) by phase",
+    "itslearning_dl_polls_total": "Polls of the watch mode",
+}
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of its bucket."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank and count:
+                return bound
+        return 0.0
+
+class Metrics:
+    """Counters, gauges and latency histograms of a run.
+
+    Thread-safe; the pool engine merges the snapshots of its worker processes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, label_key(labels))] = value
+
+    def get(self, name, default=None, **labels):
+        """Get the value of a gauge."""
+        with self.lock:
+            return self.gauges.get((name, label_key(labels)), default)
+
+    def observe(self, name, value, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, phase):
+        """Record the duration of a block in the phase histogram."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("itslearning_dl_phase_seconds", time.perf_counter() - start, phase=phase)
+
+    def snapshot(self):
+        """Picklable copy of all values."""
+        with self.lock:
+            return {
+                "counters": list(self.counters.items()),
+                "gauges": list(self.gauges.items()),
+                "histograms": [(key, (h.counts, h.sum, h.count)) for key, h in self.histograms.items()],
+            }
+
+    def merge(self, snapshot):
+        """Add the values of a snapshot, e.g. from a worker process."""
+        with self.lock:
+            for key, value in snapshot["counters"]:
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, value in snapshot["gauges"]:
+                self.gauges[key] = value
+            for key, (counts, total, count) in snapshot["histograms"]:
+                histogram = self.histograms.setdefault(key, Histogram())
+                histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                histogram.sum += total
+                histogram.count += count
+
+    def to_json(self):
+        """Summary with quantile estimates of the histograms."""
+        def entry(name, labels, **values):
+            return dict(name=name, labels=dict(labels), **values)
+        with self.lock:
+            return {
+                "counters": [entry(name, labels, value=value) for (name, labels), value in sorted(self.counters.items())],
+                "gauges": [entry(name, labels, value=value) for (name, labels), value in sorted(self.gauges.items())],
+                "histograms": [entry(name, labels, count=h.count, sum=round(h.sum, 6),
+                                     mean=round(h.sum / h.count, 6) if h.count else 0,
+                                     p50=h.quantile(0.5), p95=h.quantile(0.95), p99=h.quantile(0.99))
+                               for (name, labels), h in sorted(self.histograms.items())],
+            }
+
+    def to_prometheus(self):
+        """Prometheus text exposition format, e.g. for the node exporter textfile collector."""
+        def labels_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                header(name, "counter")
+                lines.append(f"{name}{labels_text(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                header(name, "gauge")
+                lines.append(f"{name}{labels_text(labels)} {value}")
+            for (name, labels), h in sorted(self.histograms.items()):
+                header(name, "histogram")
+                cumulative = 0
+                for bound, count in zip(BUCKETS, h.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{labels_text(labels, [('le', le)])} {cumulative}")
+                lines.append(f"{name}_sum{labels_text(labels)} {h.sum}")
+                lines.append(f"{name}_count{labels_text(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path):
+        """Write the metrics atomically; '.prom' files get the Prometheus format, others JSON."""
+        text = self.to_prometheus() if str(path).endswith(".prom") else json.dumps(self.to_json(), indent=2)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+metrics = Metrics()
@@ -0,0 +1,181 @@
+import random
+import threading
+import time
+import logging
+import weakref
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+import requests
+
+# Status codes that are retried; 429 and 503 also mean the host is overloaded
+RETRY_STATUS = {429, 500, 502, 503, 504}
+THROTTLE_STATUS = {429, 503}
+
+COUNTER_METRICS = {"retries": "itslearning_dl_retries_total", "failures": "itslearning_dl_request_failures_total"}
+
+class AimdLimiter:
+    """Concurrency limit with additive increase and multiplicative decrease.
+
+    The limit starts low and doubles per window of successful requests until
+    the host throttles for the first time, then grows by one per window and is
+    halved on every sign of overload (a throttling response or a timeout).
+    Other failures, e.g. a 500 or a refused connection, leave it unchanged.
+    """
+
+    def __init__(self, maximum, initial=4, minimum=1, cooldown=1.0):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(min(initial, maximum))
+        self.cooldown = cooldown
+        self.slow_start = True
+        self.in_flight = 0
+        self.last_decrease = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, outcome="ok"):
+        """Free a slot; outcome is "ok", "overloaded" or "failed"."""
+        with self.cond:
+            self.in_flight -= 1
+            if outcome == "overloaded":
+                # Only decrease once per cooldown, a burst of 429s is one signal
+                now = time.monotonic()
+                if now - self.last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.last_decrease = now
+                self.slow_start = False
+            elif outcome == "ok":
+                if self.slow_start:
+                    self.limit = min(self.maximum, self.limit + 1)
+                else:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+def release_on_close(response, release):
+    """Call release once the streamed response is closed (or garbage collected if it never is)."""
+    lock = threading.Lock()
+    released = []
+    close = response.close
+
+    def release_once():
+        with lock:
+            if released:
+                return
+            released.append(True)
+        release()
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            release_once()
+
+    response.close = close_and_release
+    weakref.finalize(response, release_once)
+
+class RequestScheduler:
+    """Send all requests with per-host concurrency limits, retries and backoff.
+
+    Every REST API host (one per instance) and every file host get their own
+    AIMD limiter, so throttling of one does not slow down the others. A
+    streamed response keeps its slot until it is closed, so the limit covers
+    the transfer of the body and not only the time to the first byte.
+    Latency, status codes, retries and failures per host are recorded in
+    metrics if given.
+    """
+
+    def __init__(self, api_hosts, api_limit, file_limit, max_retries=4, timeout=(5, 30), backoff_base=0.5, backoff_cap=30, metrics=None):
+        self.api_hosts = {urlparse(host).netloc for host in api_hosts}
+        self.api_limit = api_limit
+        self.file_limit = file_limit
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.limiters = {}
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.retries = 0
+        self.failures = 0
+
+    def limiter(self, url):
+        """Get the limiter of the host of a URL."""
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.limiters:
+                maximum = self.api_limit if host in self.api_hosts else self.file_limit
+                self.limiters[host] = AimdLimiter(maximum)
+            return self.limiters[host]
+
+    def backoff(self, attempt, response=None):
+        """Delay before the next attempt: Retry-After if given, else jittered exponential backoff."""
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    delay = float(retry_after)
+                except ValueError:
+                    try:
+                        delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                    except (TypeError, ValueError):
+                        delay = None
+                if delay is not None:
+                    return min(max(delay, 0), self.backoff_cap * 4)
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def count(self, name, host):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+        if self.metrics is not None:
+            self.metrics.inc(COUNTER_METRICS[name], host=host)
+
+    def record(self, host, start, status):
+        if self.metrics is not None:
+            self.metrics.observe("itslearning_dl_request_seconds", time.perf_counter() - start, host=host)
+            self.metrics.inc("itslearning_dl_requests_total", host=host, status=status)
+
+    def request(self, session, method, url, **kwargs):
+        """Send a request; returns the response or raises after the last retry."""
+        kwargs.setdefault("timeout", self.timeout)
+        host = urlparse(url).netloc
+        limiter = self.limiter(url)
+        for attempt in range(self.max_retries + 1):
+            limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                limiter.release("overloaded" if isinstance(e, requests.Timeout) else "failed")
+                self.record(host, start, type(e).__name__)
+                if attempt == self.max_retries:
+                    self.count("failures", host)
+                    raise
+                delay = self.backoff(attempt)
+                logging.debug(f"Retry {method} {url} in {delay:.1f}s: {e}")
+            else:
+                if response.status_code in THROTTLE_STATUS:
+                    outcome = "overloaded"
+                elif response.status_code >= 500:
+                    outcome = "failed"
+                else:
+                    outcome = "ok"
+                self.record(host, start, response.status_code)
+                if response.status_code not in RETRY_STATUS or attempt == self.max_retries:
+                    if response.status_code in RETRY_STATUS:
+                        self.count("failures", host)
+                    if kwargs.get("stream"):
+                        release_on_close(response, lambda: limiter.release(outcome))
+                    else:
+                        limiter.release(outcome)
+                    return response
+                limiter.release(outcome)
+                delay = self.backoff(attempt, response)
+                logging.debug(f"Retry {method} {url} in {delay:.1f}s: status {response.status_code}")
+                response.close()
+            self.count("retries", host)
+            time.sleep(delay)
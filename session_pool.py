@@ -0,0 +1,83 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+class ConnectionStats:
+    """Count opened connections and sent requests of this process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+
+    def add_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def add_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def reused(self):
+        """Number of requests that were sent on a kept-alive connection."""
+        return max(self.requests - self.connections, 0)
+
+connection_stats = ConnectionStats()
+
+class CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        connection_stats.add_connection()
+        super().connect()
+
+class CountingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        connection_stats.add_connection()
+        super().connect()
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CountingHTTPConnection
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CountingHTTPSConnection
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that counts new connections and requests."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kwargs):
+        connection_stats.add_request()
+        return super().send(request, **kwargs)
+
+class SessionPool:
+    """Keep-alive sessions, one per worker thread, on one shared connection pool.
+
+    Each thread keeps its session and cookies (e.g. the SSO cookies of
+    page.itslearning.com) for all elements it downloads.
+    """
+
+    def __init__(self, headers, pool_maxsize, pool_connections=8):
+        self.headers = headers
+        self.adapter = CountingHTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.local = threading.local()
+
+    def get(self, key=None):
+        """Get the session of the current thread; every key (e.g. account) gets its own cookies."""
+        sessions = getattr(self.local, "sessions", None)
+        if sessions is None:
+            sessions = self.local.sessions = {}
+        session = sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            session.headers.update(self.headers)
+            session.mount("https://", self.adapter)
+            session.mount("http://", self.adapter)
+            sessions[key] = session
+        return session
@@ -3,7 +3,7 @@ from setuptools import setup, find_packages
 setup(
     name='itslearning-dl',
     version='0.2',
-    py_modules=['itslearning_dl', 'conf_manager'],
+    py_modules=['itslearning_dl', 'conf_manager', 'state_store', 'session_pool', 'html_extract', 'request_scheduler', 'metrics', 'token_cache', 'blob_store', 'crawl_plan', 'size_queue', 'crawl_filter', 'account', 'crawl_snapshot'],
     packages=find_packages(),
     install_requires=[
         'beautifulsoup4',
@@ -0,0 +1,45 @@
+import bisect
+import itertools
+
+class SizeQueue:
+    """Pending downloads, handed out largest first with small ones interleaved.
+
+    Starting the largest transfers first keeps a few huge files from being
+    left for the end while the other workers idle; every small_every-th pop
+    takes the smallest file instead, so short transfers keep flowing next to
+    the long ones. Unknown sizes are estimated as the mean of the known ones.
+    """
+
+    def __init__(self, small_every=3):
+        self.small_every = small_every
+        self.items = []  # sorted (size, sequence, item)
+        self.sequence = itertools.count()
+        self.pops = 0
+        self.known_total = 0
+        self.known_count = 0
+
+    def estimate(self, size):
+        if size is not None:
+            self.known_total += size
+            self.known_count += 1
+            return size
+        return self.known_total / self.known_count if self.known_count else 0
+
+    def push(self, item, size=None):
+        # The sequence keeps the crawl order among equal sizes and never compares the items
+        bisect.insort(self.items, (self.estimate(size), -next(self.sequence), item))
+
+    def pop(self):
+        self.pops += 1
+        if self.small_every and self.pops % self.small_every == 0:
+            return self.items.pop(0)[2]
+        return self.items.pop()[2]
+
+    def __len__(self):
+        return len(self.items)
+
+def remembered_size(resource):
+    """Size of the previous download of a resource, None if unknown."""
+    previous = resource.get("Previous") or {}
+    length = previous.get("contentLength")
+    return int(length) if length and str(length).isdigit() else None
@@ -0,0 +1,524 @@
+import json
+import os
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+# Element record keys and their column in the elements table
+ELEMENT_COLUMNS = {
+    "elementId": "element_id",
+    "courseId": "course_id",
+    "title": "title",
+    "path": "path",
+    "lastUpdatedUtc": "last_updated_utc",
+    "etag": "etag",
+    "lastModified": "last_modified",
+    "contentLength": "content_length",
+    "sha256": "sha256",
+    "size": "size",
+    "mtime": "mtime",
+}
+
+# Seconds between two writes of the JSON state file while results are stored
+JSON_SAVE_INTERVAL = 10
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version
+SCHEMA = [
+    """
+    CREATE TABLE courses (
+        course_id TEXT PRIMARY KEY,
+        title TEXT,
+        last_updated REAL NOT NULL DEFAULT 0
+    );
+    CREATE TABLE folders (
+        folder_id TEXT PRIMARY KEY,
+        course_id TEXT NOT NULL,
+        title TEXT,
+        path TEXT
+    );
+    CREATE INDEX folders_course ON folders (course_id);
+    CREATE TABLE elements (
+        element_id TEXT PRIMARY KEY,
+        course_id TEXT,
+        title TEXT,
+        path TEXT,
+        last_updated_utc TEXT,
+        etag TEXT,
+        last_modified TEXT,
+        content_length TEXT,
+        sha256 TEXT,
+        updated_at REAL
+    );
+    CREATE INDEX elements_course ON elements (course_id);
+    CREATE TABLE downloads (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        element_id TEXT NOT NULL,
+        ok INTEGER NOT NULL,
+        error TEXT,
+        finished_at REAL NOT NULL
+    );
+    CREATE INDEX downloads_element ON downloads (element_id);
+    """,
+    """
+    CREATE TABLE resolutions (
+        element_id TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        resolved_at REAL NOT NULL
+    );
+    """,
+    """
+    CREATE TABLE failures (
+        element_id TEXT PRIMARY KEY,
+        resource TEXT NOT NULL,
+        error_class TEXT,
+        error TEXT,
+        attempts INTEGER NOT NULL DEFAULT 1,
+        first_failed_at REAL NOT NULL,
+        last_failed_at REAL NOT NULL
+    );
+    """,
+    """
+    ALTER TABLE elements ADD COLUMN size INTEGER;
+    ALTER TABLE elements ADD COLUMN mtime REAL;
+    """,
+    """
+    CREATE TABLE snapshots (
+        course_id TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        saved_at REAL NOT NULL
+    );
+    """,
+]
+
+class StateStore(ABC):
+    """Interface of the state backends."""
+    path = None
+
+    @abstractmethod
+    def get_course_updated(self, course_id):
+        """Get the LastUpdatedUtc timestamp of the last complete crawl of a course."""
+
+    @abstractmethod
+    def set_course(self, course_id, last_updated, title=None, folders=()):
+        """Store a completely crawled course and its folders."""
+
+    @abstractmethod
+    def get_snapshot(self, course_id):
+        """Get the crawled tree of a course (see CourseSnapshot.to_json), None if there is none."""
+
+    @abstractmethod
+    def set_snapshot(self, course_id, snapshot):
+        """Store the crawled tree of a course."""
+
+    @abstractmethod
+    def get_element(self, element_id):
+        """Get the record of the last download of an element."""
+
+    @abstractmethod
+    def get_elements(self, parent_id=None):
+        """Get the records of all downloaded elements, the manifest of the output folder.
+
+        With parent_id only the records of the files of that multi-file element.
+        """
+
+    @abstractmethod
+    def set_element(self, record):
+        """Store the record of a downloaded element."""
+
+    @abstractmethod
+    def delete_element(self, element_id):
+        """Forget the record of an element, e.g. of a file that was removed."""
+
+    @abstractmethod
+    def record_download(self, element_id, ok, error=None):
+        """Append a download result to the history."""
+
+    @abstractmethod
+    def get_resolution(self, element_id, max_age):
+        """Get the cached download location of an element if it is younger than max_age seconds."""
+
+    @abstractmethod
+    def set_resolution(self, element_id, resolution):
+        """Cache the download location of an element."""
+
+    @abstractmethod
+    def delete_resolution(self, element_id):
+        """Invalidate the cached download location of an element."""
+
+    @abstractmethod
+    def record_pending(self, resource):
+        """Queue an element handed to the downloads until its result is stored, without counting an attempt.
+
+        An interrupted run leaves it queued, so it is downloaded on the next
+        run even though its course is stored as crawled.
+        """
+
+    @abstractmethod
+    def record_failure(self, resource, error_class, error):
+        """Queue a failed element for a retry and count the attempt."""
+
+    @abstractmethod
+    def clear_failure(self, element_id):
+        """Remove an element from the failure queue."""
+
+    @abstractmethod
+    def get_failures(self, max_attempts=None):
+        """Get the queued failures, oldest first; with max_attempts only those with fewer attempts."""
+
+    @abstractmethod
+    def transaction(self):
+        """Context manager that groups writes, e.g. of one course, so they are persisted together."""
+
+    @abstractmethod
+    def clear(self):
+        """Forget everything, so all elements are fetched again."""
+
+    @abstractmethod
+    def flush(self):
+        """Persist the changes that were not written yet."""
+
+    @abstractmethod
+    def close(self):
+        """Persist and close the store."""
+
+class JsonStateStore(StateStore):
+    """State kept in memory and written to a JSON file.
+
+    The whole file is rewritten on a save, so the writes are batched: a
+    transaction that stores a crawled course saves, the others only once
+    JSON_SAVE_INTERVAL seconds passed since the last save; flush and close
+    write the rest.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.RLock()
+        self.dirty = False
+        self.save_now = False
+        self.saved_at = time.monotonic()
+        self.state = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    self.state = json.loads(f.read())
+            except ValueError:
+                logging.warning("State file corrupt! The tool may not behave as intended.")
+        self.state.setdefault("course", {})
+        self.state.setdefault("element", {})
+        self.state.setdefault("resolution", {})
+        self.state.setdefault("failure", {})
+        self.state.setdefault("snapshot", {})
+
+    def get_course_updated(self, course_id):
+        with self.lock:
+            return self.state["course"].get(str(course_id), {}).get("lastUpdated", 0)
+
+    def set_course(self, course_id, last_updated, title=None, folders=()):
+        with self.lock:
+            self.state["course"][str(course_id)] = {"lastUpdated": last_updated}
+            self.save_now = True
+
+    def get_snapshot(self, course_id):
+        with self.lock:
+            return self.state["snapshot"].get(str(course_id))
+
+    def set_snapshot(self, course_id, snapshot):
+        with self.lock:
+            self.state["snapshot"][str(course_id)] = snapshot
+
+    def get_element(self, element_id):
+        with self.lock:
+            record = self.state["element"].get(str(element_id))
+            return dict(record) if record else None
+
+    def get_elements(self, parent_id=None):
+        prefix = f"{parent_id}/"
+        with self.lock:
+            return [dict(record) for element_id, record in self.state["element"].items()
+                    if parent_id is None or element_id.startswith(prefix)]
+
+    def set_element(self, record):
+        with self.lock:
+            self.state["element"][str(record["elementId"])] = dict(record)
+
+    def delete_element(self, element_id):
+        with self.lock:
+            self.state["element"].pop(str(element_id), None)
+
+    def record_download(self, element_id, ok, error=None):
+        # The JSON backend keeps no download history
+        pass
+
+    def get_resolution(self, element_id, max_age):
+        with self.lock:
+            cached = self.state["resolution"].get(str(element_id))
+        if cached and time.time() - cached["resolvedAt"] < max_age:
+            return cached["data"]
+        return None
+
+    def set_resolution(self, element_id, resolution):
+        with self.lock:
+            self.state["resolution"][str(element_id)] = {"data": resolution, "resolvedAt": time.time()}
+
+    def delete_resolution(self, element_id):
+        with self.lock:
+            self.state["resolution"].pop(str(element_id), None)
+
+    def record_pending(self, resource):
+        now = time.time()
+        with self.lock:
+            self.state["failure"].setdefault(str(resource["ElementId"]), {
+                "resource": resource, "errorClass": "Pending", "error": "Not downloaded yet",
+                "attempts": 0, "firstFailedAt": now, "lastFailedAt": now,
+            })
+
+    def record_failure(self, resource, error_class, error):
+        now = time.time()
+        with self.lock:
+            previous = self.state["failure"].get(str(resource["ElementId"]), {})
+            self.state["failure"][str(resource["ElementId"])] = {
+                "resource": resource, "errorClass": error_class, "error": error,
+                "attempts": previous.get("attempts", 0) + 1,
+                "firstFailedAt": previous.get("firstFailedAt", now), "lastFailedAt": now,
+            }
+
+    def clear_failure(self, element_id):
+        with self.lock:
+            self.state["failure"].pop(str(element_id), None)
+
+    def get_failures(self, max_attempts=None):
+        with self.lock:
+            failures = [dict(failure) for failure in self.state["failure"].values()
+                        if max_attempts is None or failure["attempts"] < max_attempts]
+        return sorted(failures, key=lambda failure: failure["lastFailedAt"])
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            yield
+            self.dirty = True
+            if self.save_now or time.monotonic() - self.saved_at >= JSON_SAVE_INTERVAL:
+                self.save()
+
+    def save(self):
+        """Write the state file atomically."""
+        with self.lock:
+            self.dirty = self.save_now = False
+            self.saved_at = time.monotonic()
+            if self.path is None:
+                return
+            tmp_path = f"{self.path}.tmp"
+            # Readable by the user only, the cached resolutions hold session cookies
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(json.dumps(self.state))
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.path)
+
+    def clear(self):
+        with self.lock:
+            self.state = {"course": {}, "element": {}, "resolution": {}, "failure": {}, "snapshot": {}}
+            self.save()
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self.save()
+
+    def close(self):
+        self.save()
+
+class SqliteStateStore(StateStore):
+    """State in an indexed SQLite database in WAL mode."""
+
+    def __init__(self, path, json_path=None):
+        self.path = path
+        self.lock = threading.RLock()
+        # Readable by the user only, the cached resolutions hold session cookies; SQLite
+        # creates the -wal and -shm files with the permissions of the database
+        os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        os.chmod(path, 0o600)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.in_transaction = False
+        fresh = self.migrate()
+        if fresh and json_path is not None and os.path.exists(json_path):
+            self.import_json(json_path)
+
+    def migrate(self):
+        """Apply pending schema migrations; returns True for a new database."""
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        for index, script in enumerate(SCHEMA[version:], start=version + 1):
+            self.db.executescript(f"BEGIN; {script}; PRAGMA user_version = {index}; COMMIT;")
+        return version == 0
+
+    def import_json(self, json_path):
+        """One-time migration of an existing state.json."""
+        logging.info(f"Migrate {json_path} to {self.path}")
+        legacy = JsonStateStore(json_path)
+        with self.transaction():
+            for course_id, course in legacy.state["course"].items():
+                self.set_course(course_id, course.get("lastUpdated", 0))
+            for element_id, record in legacy.state["element"].items():
+                self.set_element(dict(record, elementId=element_id))
+            for failure in legacy.state["failure"].values():
+                self.record_failure(failure["resource"], failure["errorClass"], failure["error"])
+        os.replace(json_path, f"{json_path}.migrated")
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            if self.in_transaction:
+                yield
+                return
+            self.db.execute("BEGIN")
+            self.in_transaction = True
+            try:
+                yield
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            else:
+                self.db.execute("COMMIT")
+            finally:
+                self.in_transaction = False
+
+    def get_course_updated(self, course_id):
+        with self.lock:
+            row = self.db.execute("SELECT last_updated FROM courses WHERE course_id = ?", (str(course_id),)).fetchone()
+        return row["last_updated"] if row else 0
+
+    def set_course(self, course_id, last_updated, title=None, folders=()):
+        with self.transaction():
+            self.db.execute(
+                "INSERT INTO courses (course_id, title, last_updated) VALUES (?, ?, ?) "
+                "ON CONFLICT (course_id) DO UPDATE SET title = COALESCE(excluded.title, title), last_updated = excluded.last_updated",
+                (str(course_id), title, last_updated))
+            self.db.executemany(
+                "INSERT OR REPLACE INTO folders (folder_id, course_id, title, path) VALUES (?, ?, ?, ?)",
+                [(str(folder["ElementId"]), str(course_id), folder["Title"], folder["Path"]) for folder in folders])
+
+    def get_snapshot(self, course_id):
+        with self.lock:
+            row = self.db.execute("SELECT data FROM snapshots WHERE course_id = ?", (str(course_id),)).fetchone()
+        return json.loads(row["data"]) if row else None
+
+    def set_snapshot(self, course_id, snapshot):
+        with self.transaction():
+            self.db.execute(
+                "INSERT OR REPLACE INTO snapshots (course_id, data, saved_at) VALUES (?, ?, ?)",
+                (str(course_id), json.dumps(snapshot, separators=(",", ":")), time.time()))
+
+    def get_element(self, element_id):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM elements WHERE element_id = ?", (str(element_id),)).fetchone()
+        if row is None:
+            return None
+        return {key: row[column] for key, column in ELEMENT_COLUMNS.items()}
+
+    def get_elements(self, parent_id=None):
+        with self.lock:
+            if parent_id is None:
+                rows = self.db.execute("SELECT * FROM elements ORDER BY element_id").fetchall()
+            else:
+                # The files of a multi-file element have the IDs <element ID>/<index>
+                rows = self.db.execute("SELECT * FROM elements WHERE element_id LIKE ? ORDER BY element_id",
+                                       (f"{parent_id}/%",)).fetchall()
+        return [{key: row[column] for key, column in ELEMENT_COLUMNS.items()} for row in rows]
+
+    def set_element(self, record):
+        values = {column: record.get(key) for key, column in ELEMENT_COLUMNS.items()}
+        values["element_id"] = str(values["element_id"])
+        values["course_id"] = None if values["course_id"] is None else str(values["course_id"])
+        values["updated_at"] = time.time()
+        columns = ", ".join(values)
+        placeholders = ", ".join("?" for _ in values)
+        with self.transaction():
+            self.db.execute(f"INSERT OR REPLACE INTO elements ({columns}) VALUES ({placeholders})", tuple(values.values()))
+
+    def delete_element(self, element_id):
+        with self.transaction():
+            self.db.execute("DELETE FROM elements WHERE element_id = ?", (str(element_id),))
+
+    def record_download(self, element_id, ok, error=None):
+        with self.transaction():
+            self.db.execute(
+                "INSERT INTO downloads (element_id, ok, error, finished_at) VALUES (?, ?, ?, ?)",
+                (str(element_id), int(ok), error, time.time()))
+
+    def get_resolution(self, element_id, max_age):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT data FROM resolutions WHERE element_id = ? AND resolved_at > ?",
+                (str(element_id), time.time() - max_age)).fetchone()
+        return json.loads(row["data"]) if row else None
+
+    def set_resolution(self, element_id, resolution):
+        with self.transaction():
+            self.db.execute(
+                "INSERT OR REPLACE INTO resolutions (element_id, data, resolved_at) VALUES (?, ?, ?)",
+                (str(element_id), json.dumps(resolution), time.time()))
+
+    def delete_resolution(self, element_id):
+        with self.transaction():
+            self.db.execute("DELETE FROM resolutions WHERE element_id = ?", (str(element_id),))
+
+    def record_pending(self, resource):
+        now = time.time()
+        with self.transaction():
+            self.db.execute(
+                "INSERT INTO failures (element_id, resource, error_class, error, attempts, first_failed_at, last_failed_at) "
+                "VALUES (?, ?, 'Pending', 'Not downloaded yet', 0, ?, ?) ON CONFLICT (element_id) DO NOTHING",
+                (str(resource["ElementId"]), json.dumps(resource), now, now))
+
+    def record_failure(self, resource, error_class, error):
+        now = time.time()
+        with self.transaction():
+            self.db.execute(
+                "INSERT INTO failures (element_id, resource, error_class, error, first_failed_at, last_failed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (element_id) DO UPDATE SET resource = excluded.resource, "
+                "error_class = excluded.error_class, error = excluded.error, attempts = attempts + 1, "
+                "last_failed_at = excluded.last_failed_at",
+                (str(resource["ElementId"]), json.dumps(resource), error_class, error, now, now))
+
+    def clear_failure(self, element_id):
+        with self.transaction():
+            self.db.execute("DELETE FROM failures WHERE element_id = ?", (str(element_id),))
+
+    def get_failures(self, max_attempts=None):
+        query = "SELECT * FROM failures"
+        params = ()
+        if max_attempts is not None:
+            query += " WHERE attempts < ?"
+            params = (max_attempts,)
+        with self.lock:
+            rows = self.db.execute(query + " ORDER BY last_failed_at", params).fetchall()
+        return [{"resource": json.loads(row["resource"]), "errorClass": row["error_class"], "error": row["error"],
+                 "attempts": row["attempts"], "firstFailedAt": row["first_failed_at"], "lastFailedAt": row["last_failed_at"]}
+                for row in rows]
+
+    def clear(self):
+        with self.transaction():
+            for table in ("courses", "folders", "elements", "downloads", "resolutions", "failures", "snapshots"):
+                self.db.execute(f"DELETE FROM {table}")
+
+    def flush(self):
+        # Every transaction is committed already
+        pass
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def open_state_store(backend, sys_path, persist=True):
+    """Open the configured state backend in the itslearning-dl folder."""
+    if not persist:
+        return JsonStateStore()
+    if backend == "json":
+        return JsonStateStore(str(sys_path / 'state.json'))
+    return SqliteStateStore(str(sys_path / 'state.db'), json_path=str(sys_path / 'state.json'))
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from html_extract import EXTRACTORS, BeautifulSoupExtractor, get_extractor
+
+# Captured SSO, viewer and filesblock pages, some of them malformed on purpose
+PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pages")
+PAGES = sorted(name for name in os.listdir(PAGES_DIR) if name.endswith(".html"))
+
+# selectolax recovers from malformed markup like a browser, e.g. it repeats an unclosed link
+SELECTOLAX_DIVERGES = {"malformed_filesblock.html"}
+
+def read_page(name):
+    with open(os.path.join(PAGES_DIR, name), "r", encoding="utf-8") as f:
+        return f.read()
+
+def extract(extractor, html):
+    return extractor.iframe_src(html), extractor.file_links(html)
+
+def equivalence_cases():
+    for name in EXTRACTORS:
+        if name == "bs4":
+            continue
+        for page in PAGES:
+            marks = ()
+            if name == "selectolax" and page in SELECTOLAX_DIVERGES:
+                marks = pytest.mark.xfail(reason="HTML5 error recovery differs from html.parser", strict=True)
+            yield pytest.param(name, page, marks=marks, id=f"{name}-{page}")
+
+@pytest.mark.parametrize("name, page", list(equivalence_cases()))
+def test_extractor_matches_bs4(name, page):
+    if name == "selectolax":
+        pytest.importorskip("selectolax")
+    html = read_page(page)
+    assert extract(EXTRACTORS[name](), html) == extract(BeautifulSoupExtractor(), html)
+
+def test_sso_iframe():
+    assert BeautifulSoupExtractor().iframe_src(read_page("sso.html")) == (
+        "https://resource.itslearning.com/LearningObject/Viewer?LearningObjectId=987654&LearningObjectInstanceId=1234567&Culture=en-GB")
+
+def test_filesblock_links():
+    assert BeautifulSoupExtractor().file_links(read_page("filesblock.html")) == [
+        "/file/download.aspx?FileID=111&FileVersionID=-1&ChildID=-1",
+        "/file/download.aspx?FileID=112&FileVersionID=-1&ChildID=-1",
+        "/file/download.aspx?FileID=113&FileVersionID=-1&ChildID=-1",
+    ]
+
+def test_pages_without_match():
+    for page in ("sso_login.html", "viewer.html"):
+        assert extract(BeautifulSoupExtractor(), read_page(page)) == (None, [])
+
+def test_auto_is_stream():
+    assert get_extractor().name == "stream"
+    assert get_extractor("auto").name == "stream"
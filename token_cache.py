@@ -0,0 +1,66 @@
+import json
+import os
+import time
+import threading
+
+# Tokens that expire within this many seconds are refreshed before use
+EXPIRY_MARGIN = 60
+
+class TokenCache:
+    """OAuth token response of the last login, kept in a file only the user can read.
+
+    The token is stored with its absolute expiry and the instance and user it
+    belongs to, so it is never used for another account. path=None keeps the
+    token in memory only.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def load(self, instance, username):
+        """Get the cached token of an account, None if there is none."""
+        if self.path is None:
+            return None
+        with self.lock:
+            try:
+                with open(self.path, "r") as f:
+                    token = json.load(f)
+            except (OSError, ValueError):
+                return None
+        if token.get("instance") != instance or token.get("username") != username:
+            return None
+        return token
+
+    def save(self, instance, username, response):
+        """Store a token response; returns the stored token with its expiry."""
+        token = dict(response, instance=instance, username=username)
+        if "expires_in" in response:
+            token["expires_at"] = time.time() + float(response["expires_in"])
+        if self.path is None:
+            return token
+        with self.lock:
+            tmp_path = f"{self.path}.tmp"
+            # Create the file readable by the user only, before anything is written to it
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(token, f)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.path)
+        return token
+
+    def clear(self):
+        if self.path is None:
+            return
+        with self.lock:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+def is_token_valid(token):
+    """Check whether a token exists and does not expire within the margin."""
+    if not token or not token.get("access_token"):
+        return False
+    expires_at = token.get("expires_at")
+    return expires_at is None or expires_at - EXPIRY_MARGIN > time.time()